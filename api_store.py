@@ -1,32 +1,222 @@
+import json
+import logging
 import os
+import re
+import threading
 import time
 import requests
 
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 from environs import Env
+from redis.exceptions import LockError, LockNotOwnedError, RedisError
+from requests.adapters import HTTPAdapter
 from slugify import slugify
+from urllib3.util.retry import Retry
+
+from cache import LayeredCache
+from request_scope import forget, memoize
+
+# (connect, read) таймауты в секундах для групп эндпоинтов Moltin
+TIMEOUTS = {
+    'auth': (3.05, 10),
+    'catalog': (3.05, 10),
+    'files': (3.05, 20),
+    'carts': (3.05, 10),
+    'customers': (3.05, 10),
+    'flows': (3.05, 15),
+    'checkout': (3.05, 30),
+    'admin': (3.05, 30),
+}
+
+TOKEN_KEY = 'moltin:access_token'
+TOKEN_LOCK_KEY = 'moltin:access_token:lock'
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_RETRY_DELAY = 5
+TOKEN_LOCK_TIMEOUT = 30
+TOKEN_LOCK_WAIT = 15
+CATALOG_CACHE_SIZE = 512
+CATALOG_LOCAL_TTL = 300
+CATALOG_REDIS_TTL = 24 * 3600
+FILE_LINKS_KEY = 'moltin:file_links'
+PAGE_LIMIT = 100
+PAGE_PREFETCH = 4
+CUSTOMER_ADDRESS_FLOW = 'customer-address'
+CUSTOMER_ADDRESS_INDEX_KEY = 'moltin:customer_address_index'
+CUSTOMER_ADDRESS_INDEX_READY_KEY = 'moltin:customer_address_index:ready'
+CUSTOMER_ADDRESS_INDEX_BUILDING_KEY = 'moltin:customer_address_index:building'
+CUSTOMER_ADDRESS_INDEX_LOCK_KEY = 'moltin:customer_address_index:lock'
+CUSTOMER_ADDRESS_INDEX_BUILD_TTL = 3600
+COORDINATE_PRECISION = 6
+CUSTOMER_IDS_KEY = 'moltin:customer_ids'
+BRANCH_FLOW = 'branch-addresses'
+BRANCHES_TTL = 3600
+
+logger = logging.getLogger(__name__)
+
+# Содержимое корзины на момент запроса, total_amount - целая сумма Moltin в единицах валюты магазина,
+# rejected - названия товаров, которые Moltin отказался добавить в корзину с прошлого чтения
+CartSnapshot = namedtuple('CartSnapshot', ['items', 'total_amount', 'total_formatted', 'currency', 'rejected'])
+
+_session = None
+_session_lock = threading.Lock()
+_redis = None
+_token = {'access_token': None, 'expires': 0}
+_token_lock = threading.Lock()
+_token_refresher = None
+_file_links = {}
+_cart_flush_hooks = []
+_cart_rejected_hooks = []
+
+
+def init_redis(db):
+    # Общая база Redis для процессов ботов: в ней хранится токен и кэши api_store
+    global _redis
+    _redis = db
+
+
+def get_redis():
+    return _redis
+
+
+catalog_cache = LayeredCache(
+    'catalog',
+    get_redis,
+    maxsize=CATALOG_CACHE_SIZE,
+    local_ttl=CATALOG_LOCAL_TTL,
+    redis_ttl=CATALOG_REDIS_TTL
+)
+branches_cache = LayeredCache('branches', get_redis, maxsize=1, local_ttl=BRANCHES_TTL, redis_ttl=BRANCHES_TTL)
+
+
+def create_session(pool_connections=4, pool_maxsize=20, max_retries=2):
+    # Повторяем только ошибки соединения: до сервера запрос не дошел, значит повтор безопасен и для POST
+    retries = Retry(total=max_retries, connect=max_retries, read=0, status=0, backoff_factor=0.1)
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retries)
+    session = requests.Session()
+    session.headers.update({'Connection': 'keep-alive'})
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    # Сессия создается лениво: переменные окружения из .env читаются уже после импорта модуля
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session(
+                    pool_connections=int(os.getenv('MOLTIN_POOL_CONNECTIONS', 4)),
+                    pool_maxsize=int(os.getenv('MOLTIN_POOL_MAXSIZE', 20)),
+                    max_retries=int(os.getenv('MOLTIN_MAX_RETRIES', 2)),
+                )
+    return _session
+
+
+def request_token():
+    url = 'https://api.moltin.com/oauth/access_token'
+    client_id = os.getenv('CLIENT_ID')
+    client_secret = os.getenv('CLIENT_SECRET')
+    data = {
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'grant_type': 'client_credentials'
+    }
+    response = get_session().post(url, data, timeout=TIMEOUTS['auth'])
+    response.raise_for_status()
+    token_data = response.json()
+    return {'access_token': token_data['access_token'], 'expires': token_data['expires'] - 60}
+
+
+def _token_ttl(token):
+    return token['expires'] - time.time() if token and token.get('access_token') else 0
+
+
+def _load_shared_token():
+    if _redis is None:
+        return None
+    shared_token = _redis.get(TOKEN_KEY)
+    return json.loads(shared_token) if shared_token else None
+
+
+def _set_token(token):
+    with _token_lock:
+        _token.update(token)
+
+
+def refresh_token(min_ttl=0):
+    # Обновление выполняет только один процесс среди всех, использующих Redis.
+    # Блокировка Redis ожидается без блокировки процесса: остальные потоки в это время работают со своим токеном
+    with _token_lock:
+        if _token_ttl(_token) > min_ttl:
+            return
+    shared_token = _load_shared_token()
+    if _token_ttl(shared_token) > min_ttl:
+        _set_token(shared_token)
+        return
+    if _redis is None:
+        with _token_lock:
+            if _token_ttl(_token) <= min_ttl:
+                _token.update(request_token())
+        return
+    lock = _redis.lock(TOKEN_LOCK_KEY, timeout=TOKEN_LOCK_TIMEOUT)
+    if not lock.acquire(blocking_timeout=TOKEN_LOCK_WAIT):
+        # Процесс, державший блокировку, мог успеть обновить токен - новый запрос токена не отправляется
+        shared_token = _load_shared_token()
+        if _token_ttl(shared_token) > 0:
+            _set_token(shared_token)
+            return
+        raise LockError(f'Токен Moltin обновляется другим процессом дольше {TOKEN_LOCK_WAIT} с')
+    try:
+        shared_token = _load_shared_token()
+        if _token_ttl(shared_token) > min_ttl:
+            _set_token(shared_token)
+            return
+        token = request_token()
+        _redis.set(TOKEN_KEY, json.dumps(token), exat=int(token['expires']))
+        _set_token(token)
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            logger.warning('Блокировка обновления токена Moltin истекла до получения токена')
 
 
 def check_token():
-    if not os.environ.get('TOKEN_EXPIRES') or int(os.environ['TOKEN_EXPIRES']) < int(time.time()):
-        url = 'https://api.moltin.com/oauth/access_token'
-        client_id = os.getenv('CLIENT_ID')
-        client_secret = os.getenv('CLIENT_SECRET')
-        data = {
-            'client_id': client_id,
-            'client_secret': client_secret,
-            'grant_type': 'client_credentials'
-        }
-        response = requests.post(url, data)
-        response.raise_for_status()
-        token_data = response.json()
-        os.environ['TOKEN_EXPIRES'] = str(token_data['expires'] - 60)
-        os.environ['ACCESS_TOKEN'] = token_data['access_token']
+    if _token_ttl(_token) <= 0:
+        refresh_token()
+
+
+def get_access_token():
+    check_token()
+    return _token['access_token']
+
+
+def _refresh_token_forever():
+    while True:
+        try:
+            refresh_token(min_ttl=TOKEN_REFRESH_MARGIN)
+            delay = _token_ttl(_token) - TOKEN_REFRESH_MARGIN
+        except (requests.exceptions.RequestException, RedisError):
+            logger.exception('Не удалось обновить токен Moltin')
+            delay = 0
+        time.sleep(max(delay, TOKEN_RETRY_DELAY))
+
+
+def start_token_refresher():
+    # Фоновое обновление токена заранее, до истечения срока, чтобы запросы пользователей его не ждали
+    global _token_refresher
+    with _token_lock:
+        if _token_refresher is None:
+            _token_refresher = threading.Thread(target=_refresh_token_forever, name='moltin-token', daemon=True)
+            _token_refresher.start()
 
 
 def create_product(name: str, sku: str, description: str, price: int):
     url = 'https://api.moltin.com/v2/products'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -48,7 +238,7 @@ def create_product(name: str, sku: str, description: str, price: int):
             'commodity_type': 'physical'
         }
     }
-    response = requests.post(url=url, headers=headers, json=json_data)
+    response = get_session().post(url=url, headers=headers, json=json_data, timeout=TIMEOUTS['admin'])
     response.raise_for_status()
     return response.json()
 
@@ -56,7 +246,7 @@ def create_product(name: str, sku: str, description: str, price: int):
 def create_pcm_product(name: str, sku: str, description: str):
     url = 'https://api.moltin.com/pcm/products'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -72,7 +262,7 @@ def create_pcm_product(name: str, sku: str, description: str):
             },
         }
     }
-    response = requests.post(url=url, headers=headers, json=json_data)
+    response = get_session().post(url=url, headers=headers, json=json_data, timeout=TIMEOUTS['admin'])
     response.raise_for_status()
     return response.json()
 
@@ -80,7 +270,7 @@ def create_pcm_product(name: str, sku: str, description: str):
 def add_product_price(price_book_id: str, sku: str, price: int):
     url = f'https://api.moltin.com/pcm/pricebooks/{price_book_id}/prices'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -97,7 +287,7 @@ def add_product_price(price_book_id: str, sku: str, price: int):
             }
         }
     }
-    response = requests.post(url=url, headers=headers, json=json_data)
+    response = get_session().post(url=url, headers=headers, json=json_data, timeout=TIMEOUTS['admin'])
     response.raise_for_status()
     return response.json()
 
@@ -105,12 +295,12 @@ def add_product_price(price_book_id: str, sku: str, price: int):
 def upload_image_url(file_location):
     url = 'https://api.moltin.com/v2/files'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'
+        'Authorization': f'Bearer {get_access_token()}'
     }
     files = {
         'file_location': (None, file_location),
     }
-    response = requests.post(url, headers=headers, files=files)
+    response = get_session().post(url, headers=headers, files=files, timeout=TIMEOUTS['files'])
     response.raise_for_status()
     return response.json()
 
@@ -118,7 +308,7 @@ def upload_image_url(file_location):
 def create_main_image_relationship(product_id, image_id):
     url = f'https://api.moltin.com/pcm/products/{product_id}/relationships/main_image'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -127,24 +317,40 @@ def create_main_image_relationship(product_id, image_id):
             'id': image_id
         }
     }
-    response = requests.post(url=url, headers=headers, json=json_data)
+    response = get_session().post(url=url, headers=headers, json=json_data, timeout=TIMEOUTS['admin'])
     response.raise_for_status()
 
 
-def get_products():
+def fetch_products():
     url = 'https://api.moltin.com/catalog/products'
-    headers = {'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'}
-    response = requests.get(url, headers=headers)
+    headers = {'Authorization': f'Bearer {get_access_token()}'}
+    params = {'include': 'main_image'}
+    response = get_session().get(url, headers=headers, params=params, timeout=TIMEOUTS['catalog'])
     response.raise_for_status()
-    return response.json()
+    products = response.json()
+    index_included_files(products)
+    return products
 
 
-def get_product(product_id):
+@memoize
+def get_products():
+    return catalog_cache.get_or_set('products', fetch_products)
+
+
+def fetch_product(product_id):
     url = f'https://api.moltin.com/catalog/products/{product_id}'
-    headers = {'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'}
-    response = requests.get(url, headers=headers)
+    headers = {'Authorization': f'Bearer {get_access_token()}'}
+    params = {'include': 'main_image'}
+    response = get_session().get(url, headers=headers, params=params, timeout=TIMEOUTS['catalog'])
     response.raise_for_status()
-    return response.json()
+    product = response.json()
+    index_included_files(product)
+    return product
+
+
+@memoize
+def get_product(product_id):
+    return catalog_cache.get_or_set(f'product:{product_id}', lambda: fetch_product(product_id))
 
 
 def create_relationships_to_products(
@@ -154,7 +360,7 @@ def create_relationships_to_products(
 ):
     url = f'https://api.moltin.com/pcm/hierarchies/{hierarchy_id}/nodes/{node_id}/relationships/products'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json',
     }
     json_data = {'data': []}
@@ -165,25 +371,25 @@ def create_relationships_to_products(
                 'id': product['id']
             }
         )
-    response = requests.post(url, headers=headers, json=json_data)
+    response = get_session().post(url, headers=headers, json=json_data, timeout=TIMEOUTS['admin'])
     response.raise_for_status()
     return response.json()
 
 
 def get_pcm_products():
     url = 'https://api.moltin.com/pcm/products'
-    headers = {'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'}
+    headers = {'Authorization': f'Bearer {get_access_token()}'}
     params = {'include': 'component_products'}
-    response = requests.get(url, headers=headers, params=params)
+    response = get_session().get(url, headers=headers, params=params, timeout=TIMEOUTS['catalog'])
     response.raise_for_status()
     return response.json()
 
 
 def get_pcm_price_book(price_book_id):
     url = f'https://api.moltin.com/pcm/pricebooks/{price_book_id}'
-    headers = {'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'}
+    headers = {'Authorization': f'Bearer {get_access_token()}'}
     params = {'include': 'prices'}
-    response = requests.get(url, headers=headers, params=params)
+    response = get_session().get(url, headers=headers, params=params, timeout=TIMEOUTS['catalog'])
     response.raise_for_status()
     return response.json()
 
@@ -191,7 +397,7 @@ def get_pcm_price_book(price_book_id):
 def create_flow(name, description, enabled=True):  # 'id': '40a7fb8f-fc3b-42be-bd26-c2f3648b96a2'
     url = 'https://api.moltin.com/v2/flows'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -203,15 +409,15 @@ def create_flow(name, description, enabled=True):  # 'id': '40a7fb8f-fc3b-42be-b
             'enabled': enabled
         }
     }
-    response = requests.post(url=url, headers=headers, json=json_data)
+    response = get_session().post(url=url, headers=headers, json=json_data, timeout=TIMEOUTS['admin'])
     response.raise_for_status()
     return response.json()
 
 
 def delete_flow(flow_id):
     url = f'https://api.moltin.com/v2/flows/{flow_id}'
-    headers = {'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'}
-    response = requests.delete(url=url, headers=headers)
+    headers = {'Authorization': f'Bearer {get_access_token()}'}
+    response = get_session().delete(url=url, headers=headers, timeout=TIMEOUTS['admin'])
     response.raise_for_status()
 
 
@@ -228,7 +434,7 @@ def create_field(
 ):
     url = 'https://api.moltin.com/v2/fields'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -255,7 +461,7 @@ def create_field(
         json_data['data'].update({'validation_rules': validation_rules})
     if default:
         json_data['data'].update({'default': default})
-    response = requests.post(url=url, headers=headers, json=json_data)
+    response = get_session().post(url=url, headers=headers, json=json_data, timeout=TIMEOUTS['admin'])
     response.raise_for_status()
     return response.json()
 
@@ -287,7 +493,7 @@ def created_float_fields(flow_id, flows_data):
 def create_entry(flow_slug, fields_data):
     url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -297,15 +503,22 @@ def create_entry(flow_slug, fields_data):
     }
     for field_slug, field_value in fields_data.items():
         json_data['data'].update({field_slug: field_value})
-    response = requests.post(url=url, headers=headers, json=json_data)
+    response = get_session().post(url=url, headers=headers, json=json_data, timeout=TIMEOUTS['flows'])
     response.raise_for_status()
-    return response.json()
+    entry = response.json()
+    forget(get_entry_by_email, get_entry_by_pos)
+    if flow_slug == BRANCH_FLOW:
+        # Все процессы ботов перестраивают индекс филиалов по сообщению в канале сброса кэша
+        branches_cache.invalidate()
+    if flow_slug == CUSTOMER_ADDRESS_FLOW and _redis is not None:
+        index_customer_address(entry['data'])
+    return entry
 
 
 def create_entry_relationship(flow_slug, entry_id, field_slug, resource_type, resource_id):
     url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}/relationships/{field_slug}'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -316,23 +529,81 @@ def create_entry_relationship(flow_slug, entry_id, field_slug, resource_type, re
             }
         ]
     }
-    response = requests.post(url=url, headers=headers, json=json_data)
+    response = get_session().post(url=url, headers=headers, json=json_data, timeout=TIMEOUTS['flows'])
     response.raise_for_status()
     return response.json()
 
 
-def get_file(file_id):
+def fetch_file(file_id):
     url = f'https://api.moltin.com/v2/files/{file_id}'
-    headers = {'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'}
-    response = requests.get(url, headers=headers)
+    headers = {'Authorization': f'Bearer {get_access_token()}'}
+    response = get_session().get(url, headers=headers, timeout=TIMEOUTS['files'])
     response.raise_for_status()
     return response.json()
 
 
+@memoize
+def get_file(file_id):
+    return catalog_cache.get_or_set(f'file:{file_id}', lambda: fetch_file(file_id))
+
+
+def index_file_links(file_links: dict):
+    # Файлы в Moltin неизменяемы, поэтому ссылки хранятся без срока жизни
+    if not file_links:
+        return
+    _file_links.update(file_links)
+    if _redis is not None:
+        _redis.hset(FILE_LINKS_KEY, mapping=file_links)
+
+
+def index_included_files(response_data):
+    included_files = response_data.get('included', {}).get('main_images', [])
+    index_file_links({file['id']: file['link']['href'] for file in included_files})
+
+
+def get_file_links(file_ids):
+    missing_ids = [file_id for file_id in set(file_ids) if file_id not in _file_links]
+    if missing_ids and _redis is not None:
+        stored_links = _redis.hmget(FILE_LINKS_KEY, missing_ids)
+        _file_links.update(
+            {file_id: link.decode('utf-8') for file_id, link in zip(missing_ids, stored_links) if link}
+        )
+    for file_id in set(file_ids):
+        if file_id not in _file_links:
+            index_file_links({file_id: get_file(file_id)['data']['link']['href']})
+    return {file_id: _file_links[file_id] for file_id in file_ids}
+
+
+def get_file_link(file_id):
+    return get_file_links([file_id])[file_id]
+
+
+def invalidate_catalog():
+    catalog_cache.invalidate()
+
+
+def add_catalog_invalidation_hook(hook):
+    catalog_cache.add_invalidation_hook(hook)
+
+
+def add_cart_flush_hook(hook):
+    _cart_flush_hooks.append(hook)
+
+
+def add_cart_rejected_hook(hook):
+    _cart_rejected_hooks.append(hook)
+
+
+def flush_cart(reference):
+    # Отложенные изменения корзины отправляются в Moltin до ее чтения, удаления товаров и оформления заказа
+    for hook in _cart_flush_hooks:
+        hook(reference)
+
+
 def create_cart(name, description='pizza-order'):
     url = 'https://api.moltin.com/v2/carts'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json',
     }
     json_data = {
@@ -341,35 +612,74 @@ def create_cart(name, description='pizza-order'):
             'description': description
         }
     }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = get_session().post(url, headers=headers, json=json_data, timeout=TIMEOUTS['carts'])
     response.raise_for_status()
     return response.json()
 
 
+@memoize
 def get_cart(reference):
+    flush_cart(reference)
     url = f'https://api.moltin.com/v2/carts/{reference}'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
     }
-    response = requests.get(url, headers=headers)
+    response = get_session().get(url, headers=headers, timeout=TIMEOUTS['carts'])
     response.raise_for_status()
     return response.json()
 
 
+@memoize
 def get_cart_items(reference):
+    flush_cart(reference)
     url = f'https://api.moltin.com/v2/carts/{reference}/items'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
     }
-    response = requests.get(url, headers=headers)
+    response = get_session().get(url, headers=headers, timeout=TIMEOUTS['carts'])
     response.raise_for_status()
     return response.json()
 
 
+def get_cart_snapshot(reference):
+    # Ответ со списком товаров содержит и итог корзины в meta, отдельный запрос корзины не нужен
+    cart_items = get_cart_items(reference)
+    total_price = cart_items['meta']['display_price']['without_tax']
+    return CartSnapshot(
+        items=cart_items['data'],
+        total_amount=int(total_price['amount']),
+        total_formatted=total_price['formatted'],
+        currency=total_price['currency'],
+        rejected=take_rejected_products(reference)
+    )
+
+
+def get_product_name(product_id):
+    try:
+        return get_product(product_id)['data']['attributes']['name']
+    except requests.exceptions.HTTPError:
+        # Отклоненного товара может уже не быть в каталоге
+        return product_id
+
+
+def take_rejected_products(reference):
+    rejected = {}
+    for hook in _cart_rejected_hooks:
+        rejected.update(hook(reference))
+    return [get_product_name(product_id) for product_id in rejected]
+
+
+def forget_cart_reads():
+    # После изменения корзины ее повторное чтение в том же обновлении снова идет в Moltin
+    forget(get_cart, get_cart_items)
+
+
 def remove_cart_item(reference, product_id):
+    flush_cart(reference)
     url = f'https://api.moltin.com/v2/carts/{reference}/items/{product_id}'
-    headers = {'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'}
-    response = requests.delete(url, headers=headers)
+    headers = {'Authorization': f'Bearer {get_access_token()}'}
+    response = get_session().delete(url, headers=headers, timeout=TIMEOUTS['carts'])
+    forget_cart_reads()
     response.raise_for_status()
     return response.json()
 
@@ -377,7 +687,7 @@ def remove_cart_item(reference, product_id):
 def add_product_to_cart(product_id, quantity, reference):
     url = f'https://api.moltin.com/v2/carts/{reference}/items'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json',
     }
     json_data = {
@@ -387,7 +697,8 @@ def add_product_to_cart(product_id, quantity, reference):
             'quantity': quantity,
         }
     }
-    response = requests.post(url=url, headers=headers, json=json_data)
+    response = get_session().post(url=url, headers=headers, json=json_data, timeout=TIMEOUTS['carts'])
+    forget_cart_reads()
     response.raise_for_status()
     return response.json()
 
@@ -395,7 +706,7 @@ def add_product_to_cart(product_id, quantity, reference):
 def create_customer(name, email, password=None):
     url = 'https://api.moltin.com/v2/customers'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
 
@@ -408,7 +719,7 @@ def create_customer(name, email, password=None):
     json_data = {
         'data': {key: value for key, value in data.items() if value is not None}
     }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = get_session().post(url, headers=headers, json=json_data, timeout=TIMEOUTS['customers'])
     response.raise_for_status()
     return response.json()
 
@@ -416,7 +727,7 @@ def create_customer(name, email, password=None):
 def create_customer_address(customer_id, first_name, address):
     url = f'https://api.moltin.com/v2/customers/{customer_id}/addresses'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -431,49 +742,220 @@ def create_customer_address(customer_id, first_name, address):
             'city': '-'
         }
     }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = get_session().post(url, headers=headers, json=json_data, timeout=TIMEOUTS['customers'])
     response.raise_for_status()
     return response.json()
 
 
-def get_all_customers(email=None):
-    url = 'https://api.moltin.com/v2/customers'
-    headers = {'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'}
-    params = {'filter': f'eq(email,{email})'} if email else ''
-    response = requests.get(url, headers=headers, params=params)
+def index_customer_ids(customer_ids: dict):
+    if customer_ids and _redis is not None:
+        _redis.hset(CUSTOMER_IDS_KEY, mapping=customer_ids)
+
+
+def get_customer_id(name, email):
+    # Повторный покупатель находится сразу по email, без неудачного создания и последующего поиска
+    email = email.lower().strip()
+    customer_id = _redis.hget(CUSTOMER_IDS_KEY, email) if _redis is not None else None
+    if customer_id:
+        return customer_id.decode('utf-8')
+    try:
+        customer = create_customer(name, email)
+        customer_id = customer['data']['id']
+    except requests.exceptions.HTTPError:
+        found_user = get_all_customers(email)
+        customer_id = found_user['data'][0].get('id')
+    index_customer_ids({email: customer_id})
+    return customer_id
+
+
+def warm_customer_ids(batch_size=500):
+    customer_ids = {}
+    for customer in iter_customers(prefetch=PAGE_PREFETCH):
+        customer_ids[customer['email'].lower().strip()] = customer['id']
+        if len(customer_ids) >= batch_size:
+            index_customer_ids(customer_ids)
+            customer_ids = {}
+    index_customer_ids(customer_ids)
+
+
+def fetch_page(url, offset, params=None, timeout_group='flows'):
+    headers = {'Authorization': f'Bearer {get_access_token()}'}
+    page_params = dict(params or {}, **{'page[limit]': PAGE_LIMIT, 'page[offset]': offset})
+    response = get_session().get(url, headers=headers, params=page_params, timeout=TIMEOUTS[timeout_group])
     response.raise_for_status()
     return response.json()
 
 
-def get_all_entries(flow_slug='branch-addresses'):
+def iter_pages(url, params=None, timeout_group='flows', prefetch=0):
+    # prefetch - сколько следующих страниц загружать параллельно, пока обрабатывается текущая
+    first_page = fetch_page(url, 0, params, timeout_group)
+    yield first_page
+    total = first_page.get('meta', {}).get('results', {}).get('total')
+    if total is None:
+        page, offset = first_page, 0
+        while len(page['data']) == PAGE_LIMIT:
+            offset += PAGE_LIMIT
+            page = fetch_page(url, offset, params, timeout_group)
+            yield page
+        return
+    offsets = range(PAGE_LIMIT, total, PAGE_LIMIT)
+    if not prefetch:
+        for offset in offsets:
+            yield fetch_page(url, offset, params, timeout_group)
+        return
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    try:
+        pages = deque()
+        for offset in offsets:
+            pages.append(executor.submit(fetch_page, url, offset, params, timeout_group))
+            if len(pages) > prefetch:
+                yield pages.popleft().result()
+        while pages:
+            yield pages.popleft().result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_customers(email=None, prefetch=0):
+    url = 'https://api.moltin.com/v2/customers'
+    params = {'filter': f'eq(email,{email})'} if email else None
+    for page in iter_pages(url, params, timeout_group='customers', prefetch=prefetch):
+        yield from page['data']
+
+
+def iter_entries(flow_slug='branch-addresses', entries_filter=None, prefetch=0):
     url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
-    headers = {'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    params = {'filter': entries_filter} if entries_filter else None
+    for page in iter_pages(url, params, timeout_group='flows', prefetch=prefetch):
+        yield from page['data']
+
+
+def get_all_customers(email=None):
+    return {'data': list(iter_customers(email, prefetch=PAGE_PREFETCH))}
+
+
+def get_all_entries(flow_slug='branch-addresses'):
+    return {'data': list(iter_entries(flow_slug, prefetch=PAGE_PREFETCH))}
 
 
+def get_branches():
+    return branches_cache.get_or_set('entries', lambda: get_all_entries(BRANCH_FLOW)['data'])
+
+
+@memoize
 def get_entry_by_email(email, flow_slug='customer-address'):
-    all_entries = get_all_entries(flow_slug=flow_slug)
-    return list((entry for entry in all_entries['data'] if entry['email'] == email))
+    # Фильтр выполняется на стороне Moltin, проверка в Python остается на случай, если фильтр не поддерживается
+    entries = iter_entries(flow_slug, entries_filter=f'eq(email,{email})', prefetch=PAGE_PREFETCH)
+    return list((entry for entry in entries if entry['email'] == email))
+
+
+def customer_address_index_field(email, phone, customer_pos):
+    # Записи без почты, телефона или координат в индекс не попадают
+    lat, lng = customer_pos
+    if not email or not phone:
+        return None
+    try:
+        cell = f'{float(lat):.{COORDINATE_PRECISION}f}|{float(lng):.{COORDINATE_PRECISION}f}'
+    except (TypeError, ValueError):
+        return None
+    normalized_email = email.lower().strip()
+    normalized_phone = re.sub(r'\D', '', phone)
+    return f'{normalized_email}|{normalized_phone}|{cell}'
+
+
+def get_customer_address_index_field(entry):
+    return customer_address_index_field(
+        entry.get('email'),
+        entry.get('phone'),
+        (entry.get('latitude'), entry.get('longitude'))
+    )
 
 
-def get_entry_by_pos(email: str, phone: str, customer_pos: tuple, flow_slug='customer-address'):
-    all_entries = get_all_entries(flow_slug=flow_slug)
+def index_customer_address(entry):
+    field = get_customer_address_index_field(entry)
+    if field is None:
+        return
+    # Запись попадает и в индекс, который сейчас перестраивается, иначе она пропала бы при его замене
+    pipe = _redis.pipeline(transaction=False)
+    pipe.hset(CUSTOMER_ADDRESS_INDEX_KEY, field, json.dumps(entry))
+    pipe.hset(CUSTOMER_ADDRESS_INDEX_BUILDING_KEY, field, json.dumps(entry))
+    pipe.expire(CUSTOMER_ADDRESS_INDEX_BUILDING_KEY, CUSTOMER_ADDRESS_INDEX_BUILD_TTL)
+    pipe.execute()
+
+
+def swap_customer_address_index(pipe):
+    building = pipe.exists(CUSTOMER_ADDRESS_INDEX_BUILDING_KEY)
+    pipe.multi()
+    if building:
+        pipe.rename(CUSTOMER_ADDRESS_INDEX_BUILDING_KEY, CUSTOMER_ADDRESS_INDEX_KEY)
+        pipe.persist(CUSTOMER_ADDRESS_INDEX_KEY)
+    else:
+        pipe.delete(CUSTOMER_ADDRESS_INDEX_KEY)
+    pipe.set(CUSTOMER_ADDRESS_INDEX_READY_KEY, 1)
+
+
+def rebuild_customer_address_index(flow_slug=CUSTOMER_ADDRESS_FLOW):
+    """
+    Собирает индекс адресов покупателей во временном ключе и заменяет им рабочий одной командой.
+    """
+    lock = _redis.lock(CUSTOMER_ADDRESS_INDEX_LOCK_KEY, timeout=CUSTOMER_ADDRESS_INDEX_BUILD_TTL)
+    if not lock.acquire(blocking=False):
+        return
+    try:
+        _redis.delete(CUSTOMER_ADDRESS_INDEX_BUILDING_KEY)
+        index = {}
+        for entry in iter_entries(flow_slug, prefetch=PAGE_PREFETCH):
+            field = get_customer_address_index_field(entry)
+            if field is not None:
+                index[field] = json.dumps(entry)
+        if index:
+            # Записи, добавленные во время сборки, уже лежат во временном ключе и не перезаписываются
+            pipe = _redis.pipeline(transaction=True)
+            for field, entry in index.items():
+                pipe.hsetnx(CUSTOMER_ADDRESS_INDEX_BUILDING_KEY, field, entry)
+            pipe.execute()
+        _redis.transaction(swap_customer_address_index, CUSTOMER_ADDRESS_INDEX_BUILDING_KEY)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning('Блокировка сборки индекса адресов истекла до окончания сборки')
+
+
+def schedule_customer_address_index_rebuild():
+    threading.Thread(target=rebuild_customer_address_index, name='customer-address-index', daemon=True).start()
+
+
+@memoize
+def get_entry_by_pos(email: str, phone: str, customer_pos: tuple, flow_slug=CUSTOMER_ADDRESS_FLOW):
+    if _redis is not None and flow_slug == CUSTOMER_ADDRESS_FLOW:
+        if _redis.exists(CUSTOMER_ADDRESS_INDEX_READY_KEY):
+            field = customer_address_index_field(email, phone, customer_pos)
+            entry = _redis.hget(CUSTOMER_ADDRESS_INDEX_KEY, field) if field else None
+            return [json.loads(entry)] if entry else []
+        # Индекс собирается в фоне, а пока адрес ищется фильтром Moltin
+        schedule_customer_address_index_rebuild()
+    email = email.lower().strip()
+    entries = iter_entries(
+        flow_slug,
+        entries_filter=f'eq(email,{email}):eq(phone,{phone})',
+        prefetch=PAGE_PREFETCH
+    )
     return list(
         (
-            entry for entry in all_entries['data']
+            entry for entry in entries
             if (entry['latitude'], entry['longitude']) == customer_pos
-            and entry['email'] == email.lower().strip()
+            and entry['email'] == email
             and entry['phone'] == phone
         )
     )
 
 
 def checkout_cart(reference, customer_id, first_name, last_name, address, phone_number):
+    flush_cart(reference)
     url = f'https://api.moltin.com/v2/carts/{reference}/checkout'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -500,7 +982,8 @@ def checkout_cart(reference, customer_id, first_name, last_name, address, phone_
             }
         }
     }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = get_session().post(url, headers=headers, json=json_data, timeout=TIMEOUTS['checkout'])
+    forget_cart_reads()
     response.raise_for_status()
     return response.json()
 
@@ -508,7 +991,7 @@ def checkout_cart(reference, customer_id, first_name, last_name, address, phone_
 def create_category(name, description):
     url = 'https://api.moltin.com/v2/categories'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -520,15 +1003,15 @@ def create_category(name, description):
             'status': 'live'
         }
     }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = get_session().post(url, headers=headers, json=json_data, timeout=TIMEOUTS['admin'])
     response.raise_for_status()
     return response.json()
 
 
 def get_node_products(hierarchy_id, node_id):
     url = f'https://api.moltin.com/pcm/hierarchies/{hierarchy_id}/nodes/{node_id}/products'
-    headers = {'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}'}
-    response = requests.get(url, headers=headers)
+    headers = {'Authorization': f'Bearer {get_access_token()}'}
+    response = get_session().get(url, headers=headers, timeout=TIMEOUTS['catalog'])
     response.raise_for_status()
     return response.json()
 
@@ -536,7 +1019,7 @@ def get_node_products(hierarchy_id, node_id):
 def create_webhook_integration(webhook_url):
     url = 'https://api.moltin.com/v2/integrations'
     headers = {
-        'Authorization': f'Bearer {os.environ["ACCESS_TOKEN"]}',
+        'Authorization': f'Bearer {get_access_token()}',
         'Content-Type': 'application/json'
     }
     json_data = {
@@ -554,7 +1037,7 @@ def create_webhook_integration(webhook_url):
             }
         }
     }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = get_session().post(url, headers=headers, json=json_data, timeout=TIMEOUTS['admin'])
     response.raise_for_status()
     return response.json()
 
@@ -0,0 +1,249 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import aiohttp
+
+from api_store import CUSTOMER_ADDRESS_FLOW, PAGE_LIMIT, PAGE_PREFETCH, TIMEOUTS, get_access_token
+
+# Сессия aiohttp принадлежит своему циклу событий: каждый цикл (поток с asyncio.run) создает и закрывает свою
+_sessions = weakref.WeakKeyDictionary()
+_sessions_lock = threading.Lock()
+
+
+def get_session():
+    loop = asyncio.get_running_loop()
+    with _sessions_lock:
+        session = _sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=int(os.getenv('MOLTIN_ASYNC_POOL_MAXSIZE', 100)),
+                limit_per_host=int(os.getenv('MOLTIN_ASYNC_POOL_MAXSIZE', 100)),
+                keepalive_timeout=30
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            _sessions[loop] = session
+    return session
+
+
+async def close_session():
+    # Закрывается только сессия текущего цикла событий, сессии других потоков не затрагиваются
+    with _sessions_lock:
+        session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+async def _request(method, url, timeout_group, **kwargs):
+    connect_timeout, read_timeout = TIMEOUTS[timeout_group]
+    # Обновление токена синхронное и может ждать блокировку в Redis - оно выполняется вне цикла событий
+    access_token = await asyncio.to_thread(get_access_token)
+    headers = {'Authorization': f'Bearer {access_token}'}
+    headers.update(kwargs.pop('headers', {}))
+    timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+    async with get_session().request(method, url, headers=headers, timeout=timeout, **kwargs) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+async def get_products():
+    url = 'https://api.moltin.com/catalog/products'
+    return await _request('GET', url, 'catalog')
+
+
+async def get_product(product_id):
+    url = f'https://api.moltin.com/catalog/products/{product_id}'
+    return await _request('GET', url, 'catalog')
+
+
+async def get_node_products(hierarchy_id, node_id):
+    url = f'https://api.moltin.com/pcm/hierarchies/{hierarchy_id}/nodes/{node_id}/products'
+    return await _request('GET', url, 'catalog')
+
+
+async def get_file(file_id):
+    url = f'https://api.moltin.com/v2/files/{file_id}'
+    return await _request('GET', url, 'files')
+
+
+async def create_cart(name, description='pizza-order'):
+    url = 'https://api.moltin.com/v2/carts'
+    json_data = {
+        'data': {
+            'name': name,
+            'description': description
+        }
+    }
+    return await _request('POST', url, 'carts', json=json_data)
+
+
+async def get_cart(reference):
+    url = f'https://api.moltin.com/v2/carts/{reference}'
+    return await _request('GET', url, 'carts')
+
+
+async def get_cart_items(reference):
+    url = f'https://api.moltin.com/v2/carts/{reference}/items'
+    return await _request('GET', url, 'carts')
+
+
+async def remove_cart_item(reference, product_id):
+    url = f'https://api.moltin.com/v2/carts/{reference}/items/{product_id}'
+    return await _request('DELETE', url, 'carts')
+
+
+async def add_product_to_cart(product_id, quantity, reference):
+    url = f'https://api.moltin.com/v2/carts/{reference}/items'
+    json_data = {
+        'data': {
+            'id': product_id,
+            'type': 'cart_item',
+            'quantity': quantity,
+        }
+    }
+    return await _request('POST', url, 'carts', json=json_data)
+
+
+async def create_customer(name, email, password=None):
+    url = 'https://api.moltin.com/v2/customers'
+    data = {
+        'type': 'customer',
+        'name': name,
+        'email': email,
+        'password': password,
+    }
+    json_data = {
+        'data': {key: value for key, value in data.items() if value is not None}
+    }
+    return await _request('POST', url, 'customers', json=json_data)
+
+
+async def create_customer_address(customer_id, first_name, address):
+    url = f'https://api.moltin.com/v2/customers/{customer_id}/addresses'
+    json_data = {
+        'data': {
+            'type': 'address',
+            'first_name': first_name,
+            'last_name': '-',
+            'line_1': address,
+            'county': '-',
+            'country': 'RU',
+            'postcode': '-',
+            'city': '-'
+        }
+    }
+    return await _request('POST', url, 'customers', json=json_data)
+
+
+async def fetch_page(url, offset, params=None, timeout_group='flows'):
+    page_params = dict(params or {}, **{'page[limit]': PAGE_LIMIT, 'page[offset]': offset})
+    return await _request('GET', url, timeout_group, params=page_params)
+
+
+async def get_all_pages(url, params=None, timeout_group='flows', prefetch=PAGE_PREFETCH):
+    # Как api_store.iter_pages: после первой страницы остальные загружаются параллельно, не больше prefetch сразу
+    first_page = await fetch_page(url, 0, params, timeout_group)
+    pages = [first_page]
+    total = first_page.get('meta', {}).get('results', {}).get('total')
+    if total is None:
+        page, offset = first_page, 0
+        while len(page['data']) == PAGE_LIMIT:
+            offset += PAGE_LIMIT
+            page = await fetch_page(url, offset, params, timeout_group)
+            pages.append(page)
+        return pages
+    semaphore = asyncio.Semaphore(max(prefetch, 1))
+
+    async def fetch_limited(offset):
+        async with semaphore:
+            return await fetch_page(url, offset, params, timeout_group)
+
+    pages.extend(await asyncio.gather(*(fetch_limited(offset) for offset in range(PAGE_LIMIT, total, PAGE_LIMIT))))
+    return pages
+
+
+async def get_all_customers(email=None):
+    url = 'https://api.moltin.com/v2/customers'
+    params = {'filter': f'eq(email,{email})'} if email else None
+    pages = await get_all_pages(url, params, timeout_group='customers')
+    return {'data': [customer for page in pages for customer in page['data']]}
+
+
+async def create_entry(flow_slug, fields_data):
+    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
+    json_data = {
+        'data': {
+            'type': 'entry'
+        }
+    }
+    for field_slug, field_value in fields_data.items():
+        json_data['data'].update({field_slug: field_value})
+    return await _request('POST', url, 'flows', json=json_data)
+
+
+async def create_entry_relationship(flow_slug, entry_id, field_slug, resource_type, resource_id):
+    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}/relationships/{field_slug}'
+    json_data = {
+        'data': [
+            {
+                'type': resource_type,
+                'id': resource_id
+            }
+        ]
+    }
+    return await _request('POST', url, 'flows', json=json_data)
+
+
+async def get_all_entries(flow_slug='branch-addresses', entries_filter=None):
+    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
+    params = {'filter': entries_filter} if entries_filter else None
+    pages = await get_all_pages(url, params, timeout_group='flows')
+    return {'data': [entry for page in pages for entry in page['data']]}
+
+
+async def get_entry_by_email(email, flow_slug='customer-address'):
+    all_entries = await get_all_entries(flow_slug=flow_slug, entries_filter=f'eq(email,{email})')
+    return list((entry for entry in all_entries['data'] if entry['email'] == email))
+
+
+async def get_entry_by_pos(email: str, phone: str, customer_pos: tuple, flow_slug=CUSTOMER_ADDRESS_FLOW):
+    email = email.lower().strip()
+    all_entries = await get_all_entries(flow_slug=flow_slug, entries_filter=f'eq(email,{email}):eq(phone,{phone})')
+    return list(
+        (
+            entry for entry in all_entries['data']
+            if (entry['latitude'], entry['longitude']) == customer_pos
+            and entry['email'] == email
+            and entry['phone'] == phone
+        )
+    )
+
+
+async def checkout_cart(reference, customer_id, first_name, last_name, address, phone_number):
+    url = f'https://api.moltin.com/v2/carts/{reference}/checkout'
+    json_data = {
+        'data': {
+            'customer': {
+                'id': customer_id
+            },
+            'billing_address': {
+                'first_name': first_name,
+                'last_name': last_name,
+                'line_1': address,
+                'region': 'Russia',
+                'postcode': '1',
+                'country': 'RU'
+            },
+            'shipping_address': {
+                'first_name': first_name,
+                'last_name': last_name,
+                'phone_number': phone_number,
+                'line_1': address,
+                'region': 'Russia',
+                'postcode': '1',
+                'country': 'RU'
+            }
+        }
+    }
+    return await _request('POST', url, 'checkout', json=json_data)
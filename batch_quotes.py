@@ -0,0 +1,117 @@
+import argparse
+import csv
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import redis
+import requests
+from environs import Env
+
+import api_store as api
+from delivery import get_delivery_quotes
+from geo_informer import fetch_coordinates
+
+RESULT_FIELDS = ['latitude', 'longitude', 'branch_address', 'dist_km', 'tier', 'delivery_cost']
+
+
+def read_rows(file, input_format):
+    if input_format == 'csv':
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_chunks(rows, chunk_size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, chunk_size)):
+        yield chunk
+
+
+def geocode_row(apikey, row):
+    if row.get('latitude') and row.get('longitude'):
+        return float(row['latitude']), float(row['longitude'])
+    try:
+        return fetch_coordinates(apikey, row['address'])
+    except requests.exceptions.RequestException as error:
+        print(f'Не удалось определить координаты {row["address"]}: {error}', file=sys.stderr)
+        return None
+
+
+def score_chunk(executor, apikey, rows):
+    positions = list(executor.map(lambda row: geocode_row(apikey, row), rows))
+    located = [position for position in positions if position]
+    quotes = iter(get_delivery_quotes(located))
+    for row, position in zip(rows, positions):
+        result = dict(row, **{field: '' for field in RESULT_FIELDS})
+        if position:
+            quote = next(quotes)
+            result.update({
+                'latitude': position[0],
+                'longitude': position[1],
+                'branch_address': quote.branch_address,
+                'dist_km': round(quote.dist, 3),
+                'tier': quote.tier.name,
+                'delivery_cost': quote.tier.cost if quote.tier.delivery else '',
+            })
+        yield result
+
+
+def write_rows(file, output_format, rows):
+    writer = None
+    for row in rows:
+        if output_format == 'jsonl':
+            file.write(json.dumps(row, ensure_ascii=False) + '\n')
+            continue
+        if writer is None:
+            writer = csv.DictWriter(file, fieldnames=list(row.keys()), extrasaction='ignore')
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def get_format(path, explicit_format):
+    if explicit_format:
+        return explicit_format
+    return 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Расчет ближайшей пиццерии и стоимости доставки для списка адресов'
+    )
+    parser.add_argument('input', help='Файл CSV или JSONL с полем address (либо latitude/longitude), "-" - stdin')
+    parser.add_argument('-o', '--output', default='-', help='Файл для результатов, по умолчанию stdout')
+    parser.add_argument('--input-format', choices=['csv', 'jsonl'])
+    parser.add_argument('--output-format', choices=['csv', 'jsonl'])
+    parser.add_argument('--concurrency', type=int, default=8, help='Число одновременных запросов к геокодеру')
+    parser.add_argument('--chunk-size', type=int, default=500, help='Число адресов в одном пакете расчета')
+    args = parser.parse_args()
+
+    env = Env()
+    env.read_env()
+    if env('DATABASE_HOST', None):
+        api.init_redis(redis.Redis(
+            host=env('DATABASE_HOST'),
+            port=env.int('DATABASE_PORT'),
+            password=env('DATABASE_PASSWORD')
+        ))
+    apikey = env('YANDEX_GEO_TOKEN')
+    input_format = get_format(args.input, args.input_format)
+    output_format = get_format(args.output, args.output_format)
+
+    input_file = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8', newline='')
+    output_file = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')
+    with input_file, output_file, ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = (
+            result
+            for chunk in iter_chunks(read_rows(input_file, input_format), args.chunk_size)
+            for result in score_chunk(executor, apikey, chunk)
+        )
+        write_rows(output_file, output_format, results)
+
+
+if __name__ == '__main__':
+    main()
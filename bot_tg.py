@@ -2,23 +2,33 @@ import logging
 import os
 import re
 import redis
-import requests
 import api_store as api
 import buttons as btn
 from textwrap import dedent
+from cache import start_invalidation_listener
 from environs import Env
-from geo_informer import fetch_coordinates, get_min_distance_branch
+from local_cart import add_item, start_cart_flusher
+from request_scope import request_scope
+from delivery import get_delivery_message, get_delivery_quote
+from geo_informer import fetch_coordinates, schedule_branch_index_rebuild
 from telegram import Update, InlineKeyboardMarkup, LabeledPrice
+from telegram.error import BadRequest
 from telegram.ext import Filters, Updater, CallbackContext
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler, PreCheckoutQueryHandler
 from telegram.constants import PARSEMODE_HTML
 
 from logger import BotLogsHandler
+from tg_persistence import RedisPersistence
+from scheduler import schedule_job, start_scheduler
+from tg_photos import edit_cached_photo, send_cached_photo, warm_up_photos
 logger = logging.getLogger('telegram_logging')
 
 MENU_TEXT = 'Пожалуйста выберите:'
 THANK_TEXT = 'Спасибо. Мы свяжемся с Вами!'
 NONE_CART_TEXT = 'Нет в корзине'
+QUANTITY_PATTERN = re.compile(rf'<b>В корзине: (\d+) шт\.</b>|{NONE_CART_TEXT}')
+MENU_IMAGE_ID = 'menu'
+MENU_IMAGE_URL = 'https://starburger-serg.store/images/logo-pizza.png'
 GEO_REQUEST_TEXT = '<b>Для доставки вашего заказа пришлите нам ваш адрес текстом или геолокацию</b>'
 AFTER_EMAIL_TEXT = '<i>Либо продолжите выбор:</i>'
 AFTER_GEO_TEXT = '<i>Вы можете продолжить выбор, либо уточните адрес:</i>'
@@ -30,42 +40,48 @@ MESSAGE_AFTER_ORDER = f'''
 MESSAGE_AFTER_PICKUP_ORDER = 'Ваш заказ уже готов и ждет вас!'
 AFTER_ORDER_TIMER = 3600
 AFTER_PICKUP_ORDER_TIMER = 1200
-DELIVERY_COST_1 = 100
-DELIVERY_COST_2 = 300
 
 
-def start(update: Update, context: CallbackContext):
-    login_user = update.effective_user.username
-    context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=MENU_TEXT,
-        reply_markup=btn.get_main_menu()
+def show_photo_card(update: Update, context: CallbackContext, image_id, caption, reply_markup, link=None, edit=True):
+    # Меню и карточка товара - одно сообщение с фото, которое редактируется на месте
+    db = context.dispatcher.redis
+    chat_id = update.effective_chat.id
+    if edit and update.callback_query and update.effective_message.photo:
+        try:
+            edit_cached_photo(
+                context.bot,
+                db,
+                chat_id,
+                update.effective_message.message_id,
+                image_id,
+                link=link,
+                caption=caption,
+                parse_mode=PARSEMODE_HTML,
+                reply_markup=reply_markup
+            )
+            return
+        except BadRequest as error:
+            if 'not modified' in error.message:
+                return
+    # Сообщение слишком старое для редактирования или без фото - отправляется новое
+    send_cached_photo(
+        context.bot,
+        db,
+        chat_id,
+        image_id,
+        link=link,
+        caption=caption,
+        parse_mode=PARSEMODE_HTML,
+        reply_markup=reply_markup
     )
 
-    return "HANDLE_MENU"
-
 
-def send_product_info(update: Update, context: CallbackContext):
-    if update.callback_query.data == '/cart':
-        return get_cart_info(update, context)
-    if update.callback_query.data.isdigit():
-        start_product = int(update.callback_query.data)
-        context.bot.edit_message_text(
-            chat_id=update.effective_chat.id,
-            message_id=update.effective_message.message_id,
-            text=MENU_TEXT,
-            reply_markup=btn.get_main_menu(start_product)
-        )
-        return "HANDLE_MENU"
-    message_id = update.effective_message.message_id
-    chat_id = update.effective_chat.id
-    product_id = update.callback_query.data
+def show_product_card(update: Update, context: CallbackContext, product_id, edit=True):
     product_data = api.get_product(product_id)
     name = product_data['data']['attributes']['name']
     price = product_data['data']['meta']['display_price']['with_tax']['formatted']
     description = product_data['data']['attributes'].get('description', 'Описание не задано')
     main_image_id = product_data['data']['relationships']['main_image']['data']['id']
-    link_image = api.get_file(file_id=main_image_id)['data']['link']['href']
     cart_items = api.get_cart_items(update.effective_user.id)
     quantity = [item['quantity'] for item in cart_items['data'] if item['product_id'] == product_id]
     quantity_msg = f'<b>В корзине: {quantity[0]} шт.</b>' if quantity else NONE_CART_TEXT
@@ -74,19 +90,41 @@ def send_product_info(update: Update, context: CallbackContext):
         <i>{price}</i>
         {description}
         '''
-    context.bot.send_photo(
-        chat_id,
-        photo=link_image,
-        caption=dedent(msg),
-        parse_mode=PARSEMODE_HTML
+    show_photo_card(
+        update,
+        context,
+        main_image_id,
+        f'{dedent(msg)}\n{quantity_msg}',
+        btn.get_product_info_menu(product_id, price),
+        edit=edit
     )
-    context.bot.send_message(
-        chat_id,
-        text=quantity_msg,
-        reply_markup=btn.get_product_info_menu(product_id, price),
-        parse_mode=PARSEMODE_HTML
-    )
-    context.bot.delete_message(chat_id, message_id)
+
+
+def start(update: Update, context: CallbackContext):
+    show_photo_card(update, context, MENU_IMAGE_ID, MENU_TEXT, btn.get_main_menu(), link=MENU_IMAGE_URL)
+
+    return "HANDLE_MENU"
+
+
+def send_product_info(update: Update, context: CallbackContext):
+    if update.callback_query.data == '/cart':
+        return get_cart_info(update, context)
+    if update.callback_query.data.isdigit():
+        start_product = int(update.callback_query.data)
+        try:
+            context.bot.edit_message_reply_markup(
+                chat_id=update.effective_chat.id,
+                message_id=update.effective_message.message_id,
+                reply_markup=btn.get_main_menu(start_product)
+            )
+        except BadRequest as error:
+            if 'not modified' not in error.message:
+                show_photo_card(
+                    update, context, MENU_IMAGE_ID, MENU_TEXT, btn.get_main_menu(start_product),
+                    link=MENU_IMAGE_URL, edit=False
+                )
+        return "HANDLE_MENU"
+    show_product_card(update, context, update.callback_query.data)
 
     return "HANDLE_DESCRIPTION"
 
@@ -95,31 +133,29 @@ def handle_description(update: Update, context: CallbackContext):
     callback_data = update.callback_query.data
     if callback_data == '/cart':
         return get_cart_info(update, context)
-    previous_msg = update.effective_message.text
     product_info = callback_data.split(':')
     product_id = product_info[0]
     price = product_info[1]
-    api.add_product_to_cart(
-        product_id=product_id,
-        quantity=1,
-        reference=update.effective_user.id
-    )
-    if previous_msg == NONE_CART_TEXT:
-        msg = '<b>В корзине: 1 шт.</b>'
-    else:
-        quantity = int(previous_msg.split()[2])
-        msg = f'<b>В корзине: {quantity + 1} шт.</b>'
+    add_item(context.dispatcher.redis, update.effective_user.id, product_id)
+    caption = update.effective_message.caption_html or ''
+    quantity_match = QUANTITY_PATTERN.search(caption)
+    quantity = int(quantity_match.group(1) or 0) + 1 if quantity_match else 1
+    quantity_msg = f'<b>В корзине: {quantity} шт.</b>'
+    caption = QUANTITY_PATTERN.sub(quantity_msg, caption) if quantity_match else f'{caption}\n{quantity_msg}'
     answer_callback_query_text = f'''
         Добавлено в корзину
         по цене {price} за 1 шт.
         '''
-    context.bot.edit_message_text(
-        chat_id=update.effective_chat.id,
-        message_id=update.effective_message.message_id,
-        text=msg,
-        reply_markup=btn.get_product_info_menu(product_id, price),
-        parse_mode=PARSEMODE_HTML
-    )
+    try:
+        context.bot.edit_message_caption(
+            chat_id=update.effective_chat.id,
+            message_id=update.effective_message.message_id,
+            caption=caption,
+            reply_markup=btn.get_product_info_menu(product_id, price),
+            parse_mode=PARSEMODE_HTML
+        )
+    except BadRequest:
+        show_product_card(update, context, product_id, edit=False)
     context.bot.answer_callback_query(
         update.callback_query.id,
         text=dedent(answer_callback_query_text),
@@ -172,12 +208,7 @@ def handle_email(update: Update, context: CallbackContext):
         context.user_data[f'{login_user}_data'] = {'email': user_email}
         msg = 'Введите Ваш телефон'
         skip = False
-        try:
-            customer = api.create_customer(login_user, user_email)
-            context.user_data[f'{login_user}_data'].update({'customer_id': customer['data']['id']})
-        except requests.exceptions.HTTPError:
-            found_user = api.get_all_customers(user_email)
-            context.user_data[f'{login_user}_data'].update({'customer_id': found_user['data'][0].get('id')})
+        context.user_data[f'{login_user}_data'].update({'customer_id': api.get_customer_id(login_user, user_email)})
     else:
         msg = f'Введите корректный email'
         actual_return = 'HANDLE_EMAIL'
@@ -228,7 +259,7 @@ def handle_location(update: Update, context: CallbackContext):
         current_pos = fetch_coordinates(os.environ['YANDEX_GEO_TOKEN'], address)
 
     if current_pos:
-        branch_address, branch_dist, telegram_id = get_min_distance_branch(current_pos)
+        quote = get_delivery_quote(current_pos)
         user_email = context.user_data[f'{login_user}_data']['email']
         user_phone = context.user_data[f'{login_user}_data']['phone']
         existing_entry = api.get_entry_by_pos(user_email, user_phone, current_pos)
@@ -252,47 +283,9 @@ def handle_location(update: Update, context: CallbackContext):
                 resource_type='customer',
                 resource_id=context.user_data[f'{login_user}_data']['customer_id']
             )
-        reply_markup = btn.get_delivery_buttons()
-        if branch_dist <= 0.5:
-            msg = f'''
-                   Можете забрать пиццу из нашей пиццерии неподалеку?
-                   Она всего в {round(branch_dist*1000, 0)} метров от Вас!
-                   Вот её адрес: {branch_address}.
-                   А можем и бесплатно доставить нам не сложно.
-                   '''
-            delivery_cost = 0
-        elif branch_dist <= 5:
-            msg = f'''
-                   Похоже придется ехать до Вас на самокате.
-                   Доставка будет стоить {DELIVERY_COST_1} р.
-                   Доставляем или самовывоз?
-                   '''
-            delivery_cost = DELIVERY_COST_1
-        elif branch_dist <= 20:
-            msg = f'''
-                   Похоже придется ехать до Вас на автомобиле.
-                   Доставка будет стоить {DELIVERY_COST_2} р.
-                   Доставляем или самовывоз?
-                   '''
-            delivery_cost = DELIVERY_COST_2
-        elif branch_dist <= 50:
-            reply_markup = btn.get_delivery_buttons(delivery=False)
-            msg = f'''
-                   Простите но так далеко мы пиццу не доставляем.
-                   Ближайшая пиццерия от Вас в {round(branch_dist, 0)} км.
-                   Но вы может забрать её самостоятельно.
-                   Оформляем самовывоз?
-                   '''
-            delivery_cost = 0
-        else:
-            reply_markup = btn.get_delivery_buttons(pickup=False)
-            msg = f'''
-                   Простите но так далеко мы пиццу не доставляем.
-                   Ближайшая пиццерия от Вас в {round(branch_dist, 0)} км.
-                   Мы уверены, что есть другие пиццерии гораздо ближе.
-                   Либо уточните адрес доставки.
-                   '''
-        msg = f'{dedent(msg)}\n{AFTER_GEO_TEXT}'
+        reply_markup = btn.get_delivery_buttons(delivery=quote.tier.delivery, pickup=quote.tier.pickup)
+        delivery_cost = quote.tier.cost
+        msg = f'{get_delivery_message(quote)}\n{AFTER_GEO_TEXT}'
     else:
         reply_markup = btn.get_restart_button()
         msg = f'{THANK_TEXT}\n{REPIET_SEND_COORD}\n{AFTER_GEO_TEXT}'
@@ -303,7 +296,7 @@ def handle_location(update: Update, context: CallbackContext):
         reply_markup=reply_markup,
         parse_mode=PARSEMODE_HTML
     )
-    if current_pos and branch_dist <= 50:
+    if current_pos and (quote.tier.delivery or quote.tier.pickup):
         api.checkout_cart(
             reference=update.effective_user.id,
             customer_id=context.user_data[f'{login_user}_data']['customer_id'],
@@ -316,8 +309,8 @@ def handle_location(update: Update, context: CallbackContext):
             'address': address,
             'current_lat': current_lat,
             'current_lng': current_lng,
-            'telegram_id': telegram_id,
-            'branch_address': branch_address,
+            'telegram_id': quote.telegram_id,
+            'branch_address': quote.branch_address,
             'delivery_cost': delivery_cost
         })
 
@@ -328,7 +321,6 @@ def handle_location(update: Update, context: CallbackContext):
 def handle_delivery(update: Update, context: CallbackContext):
     callback_data = update.callback_query.data
     login_user = update.effective_user.username
-    value_pattern = re.compile(r'(\d+),(\d*)')
     if callback_data == 'delivery':
         msg = f'''
                Спасибо, что выбрали нашу пиццу.
@@ -339,9 +331,8 @@ def handle_delivery(update: Update, context: CallbackContext):
         delivery_latitude = user_data['current_lat']
         delivery_longitude = user_data['current_lng']
         delivery_telegram_id = user_data['telegram_id']
-        cart_msg, __, value = btn.create_cart_msg(update, context, delivery_address=delivery_address)
-        delivery_cost = user_data['delivery_cost']
-        total_value = int(''.join(value_pattern.search(value).groups())) + delivery_cost
+        cart_msg, __, cart = btn.create_cart_msg(update, context, delivery_address=delivery_address)
+        total_value = cart.total_amount + user_data['delivery_cost']
         context.bot.send_message(
             chat_id=delivery_telegram_id,
             text=dedent(cart_msg),
@@ -352,27 +343,19 @@ def handle_delivery(update: Update, context: CallbackContext):
             latitude=float(delivery_latitude),
             longitude=float(delivery_longitude)
         )
-        context.job_queue.run_once(
-            callback_after_order,
-            AFTER_ORDER_TIMER,
-            context=update.effective_chat.id
-        )
+        schedule_job(context.dispatcher.redis, 'after_order', AFTER_ORDER_TIMER, update.effective_chat.id)
     elif callback_data == 'pickup':
         msg = f'''
                Спасибо, что выбрали нашу пиццу.
                Вы можете забрать свой заказ по адресу:
                <b>{context.user_data[f'{login_user}_data']['branch_address']}</b>
                '''
-        context.job_queue.run_once(
-            callback_after_pickup_order,
-            AFTER_PICKUP_ORDER_TIMER,
-            context=update.effective_chat.id
-        )
-        __, __, value = btn.create_cart_msg(update, context)
-        total_value = int(''.join(value_pattern.search(value).groups()))
+        schedule_job(context.dispatcher.redis, 'after_pickup_order', AFTER_PICKUP_ORDER_TIMER, update.effective_chat.id)
+        cart = api.get_cart_snapshot(update.effective_user.id)
+        total_value = cart.total_amount
     context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=dedent(msg),
+        text=dedent(msg) + btn.get_rejected_msg(cart),
         reply_markup=btn.get_payment_menu(total_value),
         parse_mode=PARSEMODE_HTML
     )
@@ -411,20 +394,38 @@ def precheckout_callback(update: Update, context: CallbackContext):
     return 'START'
 
 
-def callback_after_order(context: CallbackContext):
-    context.bot.send_message(
-        chat_id=context.job.context,
+def callback_after_order(bot, chat_id):
+    bot.send_message(
+        chat_id=chat_id,
         text=dedent(MESSAGE_AFTER_ORDER)
     )
 
 
-def callback_after_pickup_order(context: CallbackContext):
-    context.bot.send_message(
-        chat_id=context.job.context,
+def callback_after_pickup_order(bot, chat_id):
+    bot.send_message(
+        chat_id=chat_id,
         text=dedent(MESSAGE_AFTER_PICKUP_ORDER)
     )
 
 
+def start_scheduled_jobs(bot, db):
+    # Отложенные сообщения хранятся в Redis и отправляются любым запущенным процессом бота.
+    # Опрос идет в отдельном потоке: JobQueue после каждой задачи сохранял бы user_data всех пользователей
+    start_scheduler(db, {
+        'after_order': lambda chat_id: callback_after_order(bot, chat_id),
+        'after_pickup_order': lambda chat_id: callback_after_pickup_order(bot, chat_id),
+    })
+
+
+def warm_up(update: Update, context: CallbackContext):
+    # Фото каталога заранее загружаются в служебный чат, чтобы покупатели сразу получали их по file_id
+    uploaded = warm_up_photos(context.bot, context.dispatcher.redis, update.effective_chat.id)
+    context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f'Загружено фото товаров: {uploaded}'
+    )
+
+
 def handle_users_reply(update: Update, context: CallbackContext):
     db = context.dispatcher.redis
     if update.message:
@@ -457,7 +458,8 @@ def handle_users_reply(update: Update, context: CallbackContext):
     }
     state_handler = states_functions[user_state]
     api.check_token()
-    next_state = state_handler(update, context)
+    with request_scope(user_state):
+        next_state = state_handler(update, context)
     db.set(chat_id, next_state)
 
 
@@ -465,22 +467,33 @@ if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
     env = Env()
     env.read_env()
-    api.check_token()
 
     token = env('TELEGRAM_TOKEN')
     database_password = env('DATABASE_PASSWORD')
     database_host = env('DATABASE_HOST')
     database_port = env('DATABASE_PORT')
-    updater = Updater(token, use_context=True)
+    db = redis.Redis(host=database_host, port=database_port, password=database_password)
+    persistence = RedisPersistence(db)
+    updater = Updater(token, use_context=True, persistence=persistence)
+    persistence.track_user_data(updater.dispatcher.user_data)
     updater.logger.addHandler(BotLogsHandler(
         token=env('TELEGRAM_TOKEN_LOG'),
         chat_id=env('CHAT_ID_LOG')
     ))
     dispatcher = updater.dispatcher
-    dispatcher.redis = redis.Redis(host=database_host, port=database_port, password=database_password)
+    dispatcher.redis = db
+    api.init_redis(dispatcher.redis)
+    api.start_token_refresher()
+    start_invalidation_listener(dispatcher.redis)
+    start_cart_flusher(dispatcher.redis)
+    schedule_branch_index_rebuild()
     updater.logger.warning('Бот Telegram "pizza-payments" запущен')
+    start_scheduled_jobs(updater.bot, dispatcher.redis)
+    service_chat_id = env.int('TELEGRAM_SERVICE_CHAT_ID', None)
+    if service_chat_id:
+        dispatcher.add_handler(CommandHandler('warmup', warm_up, filters=Filters.chat(service_chat_id), run_async=True))
     dispatcher.add_handler(PreCheckoutQueryHandler(handle_users_reply))
-    dispatcher.add_handler(CallbackQueryHandler(handle_users_reply, pass_job_queue=True))
+    dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
     dispatcher.add_handler(MessageHandler(Filters.location, handle_users_reply))
     dispatcher.add_handler(MessageHandler(Filters.text, handle_users_reply))
     dispatcher.add_handler(CommandHandler('start', handle_users_reply))
@@ -1,8 +1,13 @@
+import threading
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext
 
 import api_store as api
 
+_menu_pages = {}
+_menu_pages_lock = threading.Lock()
+
 
 def get_restart_button(skip=False):
     custom_keyboard = [[InlineKeyboardButton('Вернуться в меню', callback_data='/start')]]
@@ -14,10 +19,13 @@ def get_restart_button(skip=False):
     )
 
 
-def get_main_menu(start_product=0, offset_products=10, number_line_buttons=2):
-    products = api.get_products()['data']
-    end_index = min(start_product + offset_products, len(products))
-    displayed_products = products[start_product: end_index]
+def get_page_starts(products_count, offset_products):
+    return list(range(0, products_count, offset_products)) or [0]
+
+
+def build_menu_page(products, start_product, offset_products, number_line_buttons):
+    page_starts = get_page_starts(len(products), offset_products)
+    displayed_products = products[start_product: start_product + offset_products]
     custom_keyboard = []
     button_line = []
     for number, product in enumerate(displayed_products, start=1):
@@ -25,12 +33,13 @@ def get_main_menu(start_product=0, offset_products=10, number_line_buttons=2):
         if len(button_line) == number_line_buttons or len(button_line) == 1 and number == len(displayed_products):
             custom_keyboard.append(button_line)
             button_line = []
-    next_product = end_index if len(products) > end_index else 0
-    previous_index = start_product - offset_products
-    previous_product = previous_index if previous_index >= 0 else len(products) - offset_products
+    # С первой страницы "Назад" ведет на последнюю, с последней "Вперед" - на первую
+    page_number = page_starts.index(start_product)
+    previous_product = page_starts[page_number - 1]
+    next_product = page_starts[(page_number + 1) % len(page_starts)]
     custom_keyboard.append([
-        InlineKeyboardButton('<<<   Назад', callback_data=previous_product),
-        InlineKeyboardButton('Вперед   >>>', callback_data=next_product)
+        InlineKeyboardButton('<<<   Назад', callback_data=str(previous_product)),
+        InlineKeyboardButton('Вперед   >>>', callback_data=str(next_product))
     ])
     custom_keyboard.append([InlineKeyboardButton('Корзина', callback_data='/cart')])
     return InlineKeyboardMarkup(
@@ -39,6 +48,44 @@ def get_main_menu(start_product=0, offset_products=10, number_line_buttons=2):
     )
 
 
+def build_menu_pages(products, offset_products, number_line_buttons):
+    return {
+        start_product: build_menu_page(products, start_product, offset_products, number_line_buttons)
+        for start_product in get_page_starts(len(products), offset_products)
+    }
+
+
+def get_menu_signature(products):
+    return tuple((product['id'], product['attributes']['name']) for product in products)
+
+
+def get_menu_pages(offset_products, number_line_buttons):
+    # Страницы хранятся вместе с каталогом, по которому построены, и перестраиваются, когда каталог меняется
+    products = api.get_products()['data']
+    menu_key = (offset_products, number_line_buttons)
+    with _menu_pages_lock:
+        cached_menu = _menu_pages.get(menu_key)
+    if cached_menu is not None:
+        cached_products, signature, pages = cached_menu
+        if cached_products is products:
+            return pages
+        # Каталог, заново прочитанный из Redis, - другой объект, но кнопки меню у него могут быть прежними
+        if signature == get_menu_signature(products):
+            with _menu_pages_lock:
+                _menu_pages[menu_key] = (products, signature, pages)
+            return pages
+    pages = build_menu_pages(products, offset_products, number_line_buttons)
+    with _menu_pages_lock:
+        _menu_pages[menu_key] = (products, get_menu_signature(products), pages)
+    return pages
+
+
+def get_main_menu(start_product=0, offset_products=10, number_line_buttons=2):
+    # Страницы меню строятся один раз для версии каталога
+    pages = get_menu_pages(offset_products, number_line_buttons)
+    return pages.get(start_product, pages[0])
+
+
 def get_payment_menu(value):
     custom_keyboard = [
         [InlineKeyboardButton('Оплатить', callback_data=value)],
@@ -87,16 +134,18 @@ def get_delivery_buttons(delivery: bool = True, pickup: bool = True):
     )
 
 
-def create_cart_msg(update: Update, context: CallbackContext, delivery_address=None):
+def get_rejected_msg(cart):
+    if not cart.rejected:
+        return ''
+    return f'<i>Не удалось добавить в корзину: {", ".join(cart.rejected)}</i>'
+
+
+def create_cart_msg(update: Update, context: CallbackContext, delivery_address=None, cart=None):
     login_user = update.effective_user.username
-    total_value = (
-        api.get_cart(update.effective_user.id)
-        ['data']['meta']['display_price']['without_tax']['formatted']
-    )
-    cart_items = api.get_cart_items(update.effective_user.id)
+    cart = cart or api.get_cart_snapshot(update.effective_user.id)
     msg = ''
     custom_keyboard = []
-    for item in cart_items['data']:
+    for item in cart.items:
         msg += f'''
                 <b>{item['name']}</b>
                 {item['description']}
@@ -111,14 +160,16 @@ def create_cart_msg(update: Update, context: CallbackContext, delivery_address=N
     if not delivery_address:
         summary_msg = f'''
                 {msg}        
-                <b>Общая стоимость: {total_value}</b>
+                <b>Общая стоимость: {cart.total_formatted}</b>
+                {get_rejected_msg(cart)}
                 '''
     else:
         summary_msg = f'''
                 {msg}        
-                <b>Общая стоимость: {total_value}</b>
+                <b>Общая стоимость: {cart.total_formatted}</b>
 
                 <b>Адрес доставки: {delivery_address}</b>
                 <b>Телефон заказчика: {context.user_data[f'{login_user}_data']['phone']}</b>
                 '''
-    return summary_msg, custom_keyboard, total_value
+    return summary_msg, custom_keyboard, cart
+
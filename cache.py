@@ -0,0 +1,192 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+INVALIDATION_CHANNEL = 'cache:invalidate'
+LISTENER_RETRY_DELAY = 5
+
+_caches = {}
+_invalidation_listener = None
+
+
+class LayeredCache:
+    """
+    Двухуровневый кэш: LRU в памяти процесса перед общим слоем в Redis.
+    Значения в Redis хранятся в JSON, поэтому кэшировать можно только сериализуемые данные.
+    """
+
+    def __init__(self, name, get_redis, maxsize=256, local_ttl=300, redis_ttl=3600):
+        self.name = name
+        self.get_redis = get_redis
+        self.maxsize = maxsize
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        self.stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0}
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._invalidation_hooks = []
+        _caches[name] = self
+
+    def _redis_key(self, key):
+        return f'cache:{self.name}:{key}'
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+    def _get_local(self, key):
+        with self._lock:
+            item = self._local.get(key)
+            if item is None:
+                return MISSING
+            value, expires = item
+            if expires < time.monotonic():
+                del self._local[key]
+                return MISSING
+            self._local.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value, ttl):
+        with self._lock:
+            self._local[key] = (value, time.monotonic() + ttl)
+            self._local.move_to_end(key)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+    def get(self, key, default=MISSING):
+        value = self._get_local(key)
+        if value is not MISSING:
+            self._count('local_hits')
+            return value
+        db = self.get_redis()
+        if db is not None:
+            try:
+                pipe = db.pipeline(transaction=False)
+                pipe.get(self._redis_key(key))
+                pipe.pttl(self._redis_key(key))
+                cached_value, redis_ttl_ms = pipe.execute()
+            except RedisError:
+                logger.exception(f'Кэш {self.name}: Redis недоступен')
+                cached_value = None
+            if cached_value is not None:
+                value = json.loads(cached_value)
+                # Запись с коротким сроком (например, неудачный поиск) не живет в памяти дольше, чем в Redis
+                local_ttl = self.local_ttl
+                if redis_ttl_ms is not None and redis_ttl_ms >= 0:
+                    local_ttl = min(local_ttl, redis_ttl_ms / 1000)
+                self._set_local(key, value, local_ttl)
+                self._count('redis_hits')
+                return value
+        self._count('misses')
+        return default
+
+    def set(self, key, value, local_ttl=None, redis_ttl=None):
+        self._set_local(key, value, local_ttl or self.local_ttl)
+        db = self.get_redis()
+        if db is None:
+            return
+        try:
+            db.set(self._redis_key(key), json.dumps(value), ex=redis_ttl or self.redis_ttl)
+        except RedisError:
+            logger.exception(f'Кэш {self.name}: Redis недоступен')
+
+    def get_or_set(self, key, loader, local_ttl=None, redis_ttl=None):
+        value = self.get(key)
+        if value is MISSING:
+            value = loader()
+            self.set(key, value, local_ttl=local_ttl, redis_ttl=redis_ttl)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+        db = self.get_redis()
+        if db is not None:
+            db.delete(self._redis_key(key))
+
+    def delete_local(self, keys):
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+        for hook in self._invalidation_hooks:
+            hook()
+
+    def invalidate(self):
+        db = self.get_redis()
+        if db is not None:
+            keys = list(db.scan_iter(match=self._redis_key('*')))
+            if keys:
+                db.delete(*keys)
+        self.clear_local()
+        self.publish_invalidation()
+
+    def publish_invalidation(self, keys=None):
+        # Остальные процессы сбрасывают свой локальный слой кэша, общий слой в Redis уже актуален
+        db = self.get_redis()
+        if db is not None:
+            db.publish(INVALIDATION_CHANNEL, json.dumps({'cache': self.name, 'keys': keys}))
+
+    def add_invalidation_hook(self, hook):
+        self._invalidation_hooks.append(hook)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['local_size'] = len(self._local)
+        requests_count = stats['local_hits'] + stats['redis_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['local_hits'] + stats['redis_hits']) / requests_count if requests_count else 0
+        return stats
+
+
+def handle_invalidation(message):
+    invalidation = json.loads(message['data'])
+    cache = _caches.get(invalidation['cache'])
+    if cache is None:
+        return
+    if invalidation['keys']:
+        cache.delete_local(invalidation['keys'])
+    else:
+        cache.clear_local()
+
+
+def listen_invalidations(db):
+    while True:
+        try:
+            pubsub = db.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                # Поврежденное или чужое сообщение не должно останавливать подписку
+                try:
+                    handle_invalidation(message)
+                except (ValueError, KeyError, TypeError):
+                    logger.exception(f'Некорректное сообщение в канале сброса кэша: {message.get("data")!r}')
+        except RedisError:
+            logger.exception('Потеряно соединение с каналом сброса кэша')
+            time.sleep(LISTENER_RETRY_DELAY)
+        finally:
+            # Пока подписка не восстановлена, сообщения могли быть пропущены - локальные кэши сбрасываются
+            for cache in list(_caches.values()):
+                cache.clear_local()
+
+
+def start_invalidation_listener(db):
+    global _invalidation_listener
+    if _invalidation_listener is None:
+        _invalidation_listener = threading.Thread(
+            target=listen_invalidations,
+            args=(db,),
+            name='cache-invalidation',
+            daemon=True
+        )
+        _invalidation_listener.start()
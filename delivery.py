@@ -0,0 +1,200 @@
+import math
+import threading
+from collections import namedtuple
+from textwrap import dedent
+
+import numpy as np
+
+from geo_informer import add_branch_index_hook, get_branch_index, haversine_km, EARTH_RADIUS_KM
+
+DeliveryTier = namedtuple('DeliveryTier', ['name', 'max_dist', 'cost', 'delivery', 'pickup'])
+DeliveryQuote = namedtuple('DeliveryQuote', ['branch_address', 'dist', 'telegram_id', 'tier'])
+
+DELIVERY_TIERS = (
+    DeliveryTier('nearby', 0.5, 0, True, True),
+    DeliveryTier('scooter', 5, 100, True, True),
+    DeliveryTier('car', 20, 300, True, True),
+    DeliveryTier('pickup_only', 50, 0, False, True),
+    DeliveryTier('too_far', math.inf, 0, False, False),
+)
+DELIVERY_MESSAGES = {
+    'nearby': '''
+              Можете забрать пиццу из нашей пиццерии неподалеку?
+              Она всего в {dist_m} метров от Вас!
+              Вот её адрес: {address}.
+              А можем и бесплатно доставить нам не сложно.
+              ''',
+    'scooter': '''
+               Похоже придется ехать до Вас на самокате.
+               Доставка будет стоить {cost} р.
+               Доставляем или самовывоз?
+               ''',
+    'car': '''
+           Похоже придется ехать до Вас на автомобиле.
+           Доставка будет стоить {cost} р.
+           Доставляем или самовывоз?
+           ''',
+    'pickup_only': '''
+                   Простите но так далеко мы пиццу не доставляем.
+                   Ближайшая пиццерия от Вас в {dist_km} км.
+                   Но вы может забрать её самостоятельно.
+                   Оформляем самовывоз?
+                   ''',
+    'too_far': '''
+               Простите но так далеко мы пиццу не доставляем.
+               Ближайшая пиццерия от Вас в {dist_km} км.
+               Мы уверены, что есть другие пиццерии гораздо ближе.
+               Либо уточните адрес доставки.
+               ''',
+}
+# Точность ячейки геохэша в символах: 6 символов - ячейка примерно 1,2 x 0,6 км
+GEOHASH_PRECISION = 6
+GEOHASH_LAT_BITS = 5 * GEOHASH_PRECISION // 2
+GEOHASH_LNG_BITS = 5 * GEOHASH_PRECISION - GEOHASH_LAT_BITS
+GEOHASH_LAT_STEP = 180 / 2 ** GEOHASH_LAT_BITS
+GEOHASH_LNG_STEP = 360 / 2 ** GEOHASH_LNG_BITS
+
+_zone_table = None
+_zone_table_lock = threading.Lock()
+
+
+def get_tier(dist):
+    return next(tier for tier in DELIVERY_TIERS if dist <= tier.max_dist)
+
+
+def get_cell_indexes(lat, lng):
+    lat_index = np.floor((np.asarray(lat, dtype=float) + 90) / GEOHASH_LAT_STEP).astype(np.int64)
+    lng_index = np.floor((np.asarray(lng, dtype=float) + 180) / GEOHASH_LNG_STEP).astype(np.int64)
+    return lat_index, lng_index
+
+
+def get_distance_km(pos_1, pos_2):
+    lat_1, lng_1, lat_2, lng_2 = map(math.radians, (*pos_1, *pos_2))
+    a = math.sin((lat_2 - lat_1) / 2) ** 2 + math.cos(lat_1) * math.cos(lat_2) * math.sin((lng_2 - lng_1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1)))
+
+
+def get_cell_code(lat_index, lng_index):
+    # Чередование бит как в геохэше: старший бит долготы, затем широты и т.д.
+    code = lat_index * 0
+    for bit in range(GEOHASH_LNG_BITS):
+        code |= ((lng_index >> (GEOHASH_LNG_BITS - 1 - bit)) & 1) << (5 * GEOHASH_PRECISION - 1 - 2 * bit)
+    for bit in range(GEOHASH_LAT_BITS):
+        code |= ((lat_index >> (GEOHASH_LAT_BITS - 1 - bit)) & 1) << (5 * GEOHASH_PRECISION - 2 - 2 * bit)
+    return code
+
+
+class DeliveryZoneTable:
+    """
+    Таблица "ячейка геохэша -> (филиал, тариф)" для зоны обслуживания.
+    В таблицу попадают только ячейки, целиком лежащие в одном тарифе одного филиала,
+    для ячеек на границах зон стоимость рассчитывается точно.
+    """
+
+    def __init__(self, branch_index, max_dist=DELIVERY_TIERS[-2].max_dist):
+        self.branch_index = branch_index
+        self.cells = {}
+        branches = np.degrees(branch_index.coords)
+        lat_radius = max_dist / EARTH_RADIUS_KM * 180 / math.pi
+        cell_rows = []
+        for branch_lat, branch_lng in branches:
+            lng_radius = lat_radius / max(math.cos(math.radians(branch_lat)), 0.01)
+            lat_from, lng_from = get_cell_indexes(branch_lat - lat_radius, branch_lng - lng_radius)
+            lat_to, lng_to = get_cell_indexes(branch_lat + lat_radius, branch_lng + lng_radius)
+            lat_indexes, lng_indexes = np.meshgrid(
+                np.arange(lat_from, lat_to + 1),
+                np.arange(lng_from, lng_to + 1),
+                indexing='ij'
+            )
+            cell_rows.append((lat_indexes.ravel() << 32) | lng_indexes.ravel())
+        if not cell_rows:
+            return
+        cell_keys = np.unique(np.concatenate(cell_rows))
+        lat_indexes, lng_indexes = cell_keys >> 32, cell_keys & 0xFFFFFFFF
+        centers = np.stack(
+            ((lat_indexes + 0.5) * GEOHASH_LAT_STEP - 90, (lng_indexes + 0.5) * GEOHASH_LNG_STEP - 180),
+            axis=1
+        )
+        corners = centers + np.array([GEOHASH_LAT_STEP / 2, GEOHASH_LNG_STEP / 2])
+        cell_radius = haversine_km(np.radians(centers), np.radians(corners))
+        indexes, distances = branch_index.query(centers, k=2)
+        nearest_dist = distances[:, 0]
+        second_dist = distances[:, 1] if distances.shape[1] > 1 else np.full_like(nearest_dist, np.inf)
+        max_dists = [tier.max_dist for tier in DELIVERY_TIERS]
+        min_tiers = np.searchsorted(max_dists, nearest_dist - cell_radius, side='left')
+        max_tiers = np.searchsorted(max_dists, nearest_dist + cell_radius, side='left')
+        is_stable = (second_dist - nearest_dist > 2 * cell_radius) & (min_tiers == max_tiers)
+        codes = get_cell_code(lat_indexes[is_stable], lng_indexes[is_stable])
+        self.cells = dict(zip(codes.tolist(), zip(indexes[is_stable, 0].tolist(), min_tiers[is_stable].tolist())))
+
+    def lookup(self, client_pos):
+        lat, lng = client_pos
+        lat_index = math.floor((lat + 90) / GEOHASH_LAT_STEP)
+        lng_index = math.floor((lng + 180) / GEOHASH_LNG_STEP)
+        cell = self.cells.get(get_cell_code(lat_index, lng_index))
+        if cell is None:
+            return None
+        branch_number, tier_index = cell
+        branch = self.branch_index.branches[branch_number]
+        dist = get_distance_km(client_pos, (branch['latitude'], branch['longitude']))
+        return DeliveryQuote(branch['address'], dist, branch['telegram_id'], DELIVERY_TIERS[tier_index])
+
+
+def build_zone_table(branch_index):
+    # Вызывается при перестроении индекса филиалов в фоновом потоке: таблица заменяется готовой
+    global _zone_table
+    _zone_table = DeliveryZoneTable(branch_index)
+
+
+def get_zone_table():
+    global _zone_table
+    branch_index = get_branch_index()
+    if _zone_table is None:
+        with _zone_table_lock:
+            if _zone_table is None:
+                _zone_table = DeliveryZoneTable(branch_index)
+    return _zone_table
+
+
+def get_delivery_quote(client_pos):
+    zone_table = get_zone_table()
+    quote = zone_table.lookup(client_pos)
+    if quote:
+        return quote
+    # Точный расчет по индексу, из которого построена таблица, чтобы ответ не зависел от момента замены индекса
+    branch_index = zone_table.branch_index
+    indexes, distances = branch_index.query([client_pos])
+    branch = branch_index.branches[int(indexes[0, 0])]
+    dist = float(distances[0, 0])
+    return DeliveryQuote(branch['address'], dist, branch['telegram_id'], get_tier(dist))
+
+
+def get_delivery_quotes(positions):
+    # Пакетный расчет: ближайшие филиалы и тарифы для всех точек за один векторный проход
+    if not len(positions):
+        return []
+    branch_index = get_branch_index()
+    indexes, distances = branch_index.query(positions)
+    tier_indexes = np.searchsorted([tier.max_dist for tier in DELIVERY_TIERS], distances[:, 0], side='left')
+    return [
+        DeliveryQuote(
+            branch_index.branches[index]['address'],
+            float(dist),
+            branch_index.branches[index]['telegram_id'],
+            DELIVERY_TIERS[tier_index]
+        )
+        for index, dist, tier_index in zip(indexes[:, 0].tolist(), distances[:, 0].tolist(), tier_indexes.tolist())
+    ]
+
+
+def get_delivery_message(quote: DeliveryQuote):
+    msg = DELIVERY_MESSAGES[quote.tier.name].format(
+        dist_m=round(quote.dist * 1000, 0),
+        dist_km=round(quote.dist, 0),
+        address=quote.branch_address,
+        cost=quote.tier.cost
+    )
+    return dedent(msg)
+
+
+add_branch_index_hook(build_zone_table)
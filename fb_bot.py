@@ -2,14 +2,19 @@ import os
 import re
 import redis
 import api_store as api
-import json
 
 import requests
 from flask import Flask, request
-from textwrap import dedent
-from geo_informer import fetch_coordinates, get_min_distance_branch
+from delivery import get_delivery_message, get_delivery_quote
+from geo_informer import fetch_coordinates, schedule_branch_index_rebuild
 from api_fb import get_button_template, get_generic_template
 from api_fb import FACEBOOK_TOKEN
+from cache import start_invalidation_listener
+from fb_catalog import ensure_node_elements, mark_refresh_pending
+from fb_queue import enqueue_event
+from local_cart import add_item, start_cart_flusher
+from request_scope import request_scope
+from fb_session import load_session, save_session
 
 app = Flask(__name__)
 
@@ -17,18 +22,22 @@ database_password = os.environ['DATABASE_PASSWORD']
 database_host = os.environ['DATABASE_HOST']
 database_port = os.environ['DATABASE_PORT']
 db = redis.Redis(host=database_host, port=int(database_port), password=database_password)
+api.init_redis(db)
+api.start_token_refresher()
+start_invalidation_listener(db)
+start_cart_flusher(db)
+schedule_branch_index_rebuild()
 
 THANK_TEXT = 'Спасибо. Мы свяжемся с Вами!'
 GEO_REQUEST_TEXT = 'Для доставки вашего заказа пришлите нам ваш адрес текстом'
 AFTER_EMAIL_TEXT = 'Либо вернитесь к выбору:'
-DELIVERY_COST_1 = 100
-DELIVERY_COST_2 = 300
 AFTER_GEO_TEXT = 'Вы можете продолжить выбор, либо уточните адрес:'
 REPIET_SEND_COORD = 'Извините, но мы не смогли определить ваши координаты!'
 SPECIAL_NODE_ID = '07f5eb2c-815e-41c9-be78-a41b985dd430'
 SATISFYING_NODE_ID = '18557b54-9f75-4ce3-92e1-637c402100aa'
 SPICY_NODE_ID = '6111eb37-d408-40aa-a7d1-87cfbc17e044'
 FRONT_PAGE_NODE_ID = 'd00bc494-5ecd-44f2-a943-2b46f745e200'
+CATALOG_NODE_IDS = [FRONT_PAGE_NODE_ID, SPECIAL_NODE_ID, SATISFYING_NODE_ID, SPICY_NODE_ID]
 
 
 @app.route('/', methods=['GET'])
@@ -48,18 +57,17 @@ def verify():
 def webhook():
     """
     Основной вебхук, на который будут приходить сообщения от Facebook.
+    Сообщения ставятся в очередь Redis и обрабатываются процессом fb_worker.py, ответ Facebook отправляется сразу.
     """
     data = request.get_json()
     if data.get('object') == 'page':
         for entry in data['entry']:
             for messaging_event in entry['messaging']:
-                if messaging_event.get('message'):
-                    handle_users_reply(messaging_event)
-                elif messaging_event.get('postback'):
-                    handle_users_reply(messaging_event)
+                if messaging_event.get('message') or messaging_event.get('postback'):
+                    enqueue_event(db, messaging_event, partition_key=messaging_event['sender']['id'])
     elif data.get('triggered_by') == 'catalog-release.updated':
-        for node_id in [FRONT_PAGE_NODE_ID, SPECIAL_NODE_ID, SATISFYING_NODE_ID, SPICY_NODE_ID]:
-            get_product_elements(node_id, event=True)
+        if mark_refresh_pending(db):
+            enqueue_event(db, {'type': 'catalog_refresh'}, partition_key='catalog')
     return "ok", 200
 
 
@@ -81,18 +89,14 @@ def send_message(recipient_id, message_text):
     response.raise_for_status()
 
 
-def handle_start(recipient_id, message_text=FRONT_PAGE_NODE_ID, title=None):
+def handle_start(recipient_id, session, message_text=FRONT_PAGE_NODE_ID, title=None):
     if title == 'Добавить в корзину':
         product_id, product_name = message_text.split('_')
-        api.add_product_to_cart(
-            product_id=product_id,
-            quantity=1,
-            reference=recipient_id
-        )
+        add_item(db, recipient_id, product_id)
         send_message(recipient_id, f'В корзину добавлена пицца {product_name}')
         return 'START'
     elif title == 'Корзина':
-        return handler_cart(recipient_id)
+        return handler_cart(recipient_id, session)
     elif title == 'Сделать заказ':
         send_message(
             recipient_id,
@@ -115,9 +119,8 @@ def handle_start(recipient_id, message_text=FRONT_PAGE_NODE_ID, title=None):
         )
         return 'HANDLE_EMAIL'
 
-    pattern_category = re.compile(r'\b\w{8}-\w{4}-\w{4}-\w{4}-\w{12}')
-    node_id_verify = bool(pattern_category.match(message_text))
-    node_id = message_text if node_id_verify else FRONT_PAGE_NODE_ID
+    # Каталог собирается только для известных категорий, любой другой текст открывает главную страницу
+    node_id = message_text if message_text in CATALOG_NODE_IDS else FRONT_PAGE_NODE_ID
     elements = [
         {
             'title': 'Меню',
@@ -173,48 +176,17 @@ def handle_start(recipient_id, message_text=FRONT_PAGE_NODE_ID, title=None):
     return 'START'
 
 
-def get_product_elements(node_id, event=False):
-    product_elements = db.get(node_id)
-    if not product_elements or event:
-        product_elements = []
-        products = api.get_products()['data']
-        node_products = api.get_node_products(os.environ['HIERARCHY_ID'], node_id)
-        node_product_ids = [product['id'] for product in node_products['data']]
-        for product in products:
-            if product['id'] in node_product_ids:
-                main_image_id = product['relationships']['main_image']['data']['id']
-                link_image = api.get_file(file_id=main_image_id)['data']['link']['href']
-                product_elements.append(
-                    {
-                        'title': f'{product["attributes"]["name"]} ({product["attributes"]["price"]["RUB"]["amount"]} р.)',
-                        'image_url': link_image,
-                        'subtitle': product['attributes'].get('description', ''),
-                        'buttons': [
-                            {
-                                'type': 'postback',
-                                'title': 'Добавить в корзину',
-                                'payload': f"{product['id']}_{product['attributes']['name']}",
-                            }
-                        ]
-                    },
-                )
-        db.set(node_id, json.dumps(product_elements))
-    else:
-        product_elements = json.loads(product_elements)
-
-    return product_elements
+def get_product_elements(node_id):
+    # Пока фоновое обновление не переключило версию каталога, отдается предыдущая версия
+    return ensure_node_elements(db, node_id, CATALOG_NODE_IDS)
 
 
-def handler_cart(recipient_id, message_text=None, title=None):
+def handler_cart(recipient_id, session, message_text=None, title=None):
     if title == 'К меню':
-        return handle_start(recipient_id, message_text)
+        return handle_start(recipient_id, session, message_text)
     elif title == 'Добавить еще одну':
         product_id, product_name = message_text.split('_')
-        api.add_product_to_cart(
-            product_id=product_id,
-            quantity=1,
-            reference=recipient_id
-        )
+        add_item(db, recipient_id, product_id)
         send_message(recipient_id, f'В корзину добавлена пицца {product_name}')
     elif title == 'Убрать из корзины':
         item_cart_id, product_name = message_text.split('_')
@@ -224,14 +196,12 @@ def handler_cart(recipient_id, message_text=None, title=None):
     #     pass
     # elif title == 'Самовывоз':
     #     pass
-    total_value = (
-        api.get_cart(recipient_id)
-        ['data']['meta']['display_price']['without_tax']['formatted']
-    )
-    cart_items = api.get_cart_items(recipient_id)
+    cart = api.get_cart_snapshot(recipient_id)
+    if cart.rejected:
+        send_message(recipient_id, f'Не удалось добавить в корзину: {", ".join(cart.rejected)}')
     elements = [
         {
-            'title': f'Ваш заказ на сумму {total_value}',
+            'title': f'Ваш заказ на сумму {cart.total_formatted}',
             'image_url': 'https://starburger-serg.store/images/cart.jpg',
             'subtitle': 'Выберите, чтобы вы хотели:',
             'buttons': [
@@ -253,7 +223,7 @@ def handler_cart(recipient_id, message_text=None, title=None):
             ]
         }
     ]
-    for item in cart_items['data']:
+    for item in cart.items:
         elements.append(
             {
                 'title': f"{item['name']} ({item['quantity']} шт.)",
@@ -278,7 +248,7 @@ def handler_cart(recipient_id, message_text=None, title=None):
     return 'HANDLER_CART'
 
 
-def handle_email(recipient_id, message_text=None, title=None):
+def handle_email(recipient_id, session, message_text=None, title=None):
     if message_text == 'NEXT_STEP':
         user_email = 'none@none.com'
     else:
@@ -286,14 +256,10 @@ def handle_email(recipient_id, message_text=None, title=None):
     email_rule = re.compile(r'(^\S+@\S+\.\S+$)', flags=re.IGNORECASE)
     if email_rule.search(user_email):
         actual_return = 'HANDLE_PHONE'
-        db.set(f'{recipient_id}_mail', user_email)
+        session.set('email', user_email)
         msg = 'Введите Ваш телефон'
-        try:
-            customer = api.create_customer(f'facebookid_{recipient_id}', user_email)
-            db.set(f'{recipient_id}_customer_id', customer['data']['id'])
-        except requests.exceptions.HTTPError:
-            found_user = api.get_all_customers(user_email)
-            db.set(f'{recipient_id}_customer_id', found_user['data'][0].get('id'))
+        customer_id = api.get_customer_id(f'facebookid_{recipient_id}', user_email)
+        session.set('customer_id', customer_id)
     else:
         msg = f'Введите корректный email'
         actual_return = 'HANDLE_EMAIL'
@@ -312,12 +278,12 @@ def handle_email(recipient_id, message_text=None, title=None):
     return actual_return
 
 
-def handle_phone(recipient_id, message_text=None, title=None):
+def handle_phone(recipient_id, session, message_text=None, title=None):
     user_phone = message_text
     phone_rule = re.compile(r'(^[+0-9]{1,3})*([0-9]{10,11}$)')
     if phone_rule.search(user_phone):
         actual_return = 'HANDLE_LOCATION'
-        db.set(f'{recipient_id}_phone', user_phone)
+        session.set('phone', user_phone)
         msg = f'{THANK_TEXT}\n{GEO_REQUEST_TEXT}'
     else:
         actual_return = 'HANDLE_PHONE'
@@ -337,15 +303,15 @@ def handle_phone(recipient_id, message_text=None, title=None):
     return actual_return
 
 
-def handle_location(recipient_id, message_text=None, title=None):
+def handle_location(recipient_id, session, message_text=None, title=None):
 
     address = message_text
     current_pos = fetch_coordinates(os.environ['YANDEX_GEO_TOKEN'], address)
 
     if current_pos:
-        branch_address, branch_dist, telegram_id = get_min_distance_branch(current_pos)
-        user_email = db.get(f'{recipient_id}_mail').decode('utf-8')
-        user_phone = db.get(f'{recipient_id}_phone').decode('utf-8')
+        quote = get_delivery_quote(current_pos)
+        user_email = session.get('email')
+        user_phone = session.get('phone')
         existing_entry = api.get_entry_by_pos(user_email, user_phone, current_pos)
         address = address if address else 'Пользователь не указал адрес'
         current_lat, current_lng = current_pos
@@ -365,57 +331,20 @@ def handle_location(recipient_id, message_text=None, title=None):
                 entry_id=customer_address_entry['data']['id'],
                 field_slug='customer',
                 resource_type='customer',
-                resource_id=db.get(f'{recipient_id}_customer_id').decode('utf-8')
+                resource_id=session.get('customer_id')
             )
-        if branch_dist <= 0.5:
-            msg = f'''
-                   Можете забрать пиццу из нашей пиццерии неподалеку?
-                   Она всего в {round(branch_dist*1000, 0)} метров от Вас!
-                   Вот её адрес: {branch_address}.
-                   А можем и бесплатно доставить нам не сложно.
-                   '''
-            delivery_cost = 0
-        elif branch_dist <= 5:
-            msg = f'''
-                   Похоже придется ехать до Вас на самокате.
-                   Доставка будет стоить {DELIVERY_COST_1} р.
-                   Доставляем или самовывоз?
-                   '''
-            delivery_cost = DELIVERY_COST_1
-        elif branch_dist <= 20:
-            msg = f'''
-                   Похоже придется ехать до Вас на автомобиле.
-                   Доставка будет стоить {DELIVERY_COST_2} р.
-                   Доставляем или самовывоз?
-                   '''
-            delivery_cost = DELIVERY_COST_2
-        elif branch_dist <= 50:
-            msg = f'''
-                   Простите но так далеко мы пиццу не доставляем.
-                   Ближайшая пиццерия от Вас в {round(branch_dist, 0)} км.
-                   Но вы может забрать её самостоятельно.
-                   Оформляем самовывоз?
-                   '''
-            delivery_cost = 0
-        else:
-            msg = f'''
-                   Простите но так далеко мы пиццу не доставляем.
-                   Ближайшая пиццерия от Вас в {round(branch_dist, 0)} км.
-                   Мы уверены, что есть другие пиццерии гораздо ближе.
-                   Либо уточните адрес доставки.
-                   '''
-        msg = f'{dedent(msg)}\n{AFTER_GEO_TEXT}'
+        msg = f'{get_delivery_message(quote)}\n{AFTER_GEO_TEXT}'
     else:
         msg = f'{THANK_TEXT}\n{REPIET_SEND_COORD}\n{AFTER_GEO_TEXT}'
     send_message(recipient_id, msg)
-    if current_pos and branch_dist <= 50:
+    if current_pos and (quote.tier.delivery or quote.tier.pickup):
         api.checkout_cart(
             reference=recipient_id,
-            customer_id=db.get(f'{recipient_id}_customer_id').decode('utf-8'),
+            customer_id=session.get('customer_id'),
             first_name='Test',
             last_name='Test',
             address=address,
-            phone_number=db.get(f'{recipient_id}_phone').decode('utf-8')
+            phone_number=session.get('phone')
         )
         return 'START'
     return 'START'
@@ -438,17 +367,18 @@ def handle_users_reply(messaging_event):
         'HANDLE_PHONE': handle_phone,
         'HANDLE_LOCATION': handle_location,
     }
-    recorded_state = db.get(f'facebookid_{sender_id}')
-    if not recorded_state or recorded_state.decode("utf-8") not in states_functions.keys():
+    session = load_session(db, sender_id)
+    user_state = session.get('state')
+    if user_state not in states_functions.keys():
         user_state = "START"
-    else:
-        user_state = recorded_state.decode("utf-8")
     if message_text == "/start":
         user_state = "START"
     state_handler = states_functions[user_state]
     api.check_token()
-    next_state = state_handler(sender_id, message_text, title)
-    db.set(f'facebookid_{sender_id}', next_state)
+    with request_scope(user_state):
+        next_state = state_handler(sender_id, session, message_text, title)
+    session.set('state', next_state)
+    save_session(db, session)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+import api_store as api
+import api_store_async as api_async
+
+logger = logging.getLogger(__name__)
+
+CURRENT_VERSION_KEY = 'fb_catalog:current'
+REFRESH_PENDING_KEY = 'fb_catalog:refresh_pending'
+REFRESH_LOCK_KEY = 'fb_catalog:refresh_lock'
+MANIFEST_KEY = 'fb_catalog:manifest:{version}'
+PRODUCTS_KEY = 'fb_catalog:products:{version}'
+NODE_KEY = 'fb_catalog:node:{digest}'
+PRODUCT_KEY = 'fb_catalog:product:{digest}'
+CONTENT_TTL = 30 * 24 * 3600
+PREVIOUS_VERSION_TTL = 3600
+REFRESH_PENDING_TTL = 300
+REFRESH_LOCK_TIMEOUT = 120
+
+_read_node_script = None
+
+# Чтение категории версии каталога KEYS[1] одним запросом: дайджест категории -> дайджесты товаров -> элементы
+READ_NODE_SCRIPT = '''
+local node_digest = redis.call('HGET', KEYS[1], ARGV[1])
+if not node_digest then return nil end
+local node = redis.call('GET', 'fb_catalog:node:' .. node_digest)
+if not node then return nil end
+local product_digests = cjson.decode(node)
+if #product_digests == 0 then return '[]' end
+local keys = {}
+for i, digest in ipairs(product_digests) do keys[i] = 'fb_catalog:product:' .. digest end
+local elements = redis.call('MGET', unpack(keys))
+for i = 1, #elements do
+    if not elements[i] then return nil end
+end
+return '[' .. table.concat(elements, ',') .. ']'
+'''
+
+
+def get_digest(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def get_product_element(product, link_image):
+    return {
+        'title': f'{product["attributes"]["name"]} ({product["attributes"]["price"]["RUB"]["amount"]} р.)',
+        'image_url': link_image,
+        'subtitle': product['attributes'].get('description', ''),
+        'buttons': [
+            {
+                'type': 'postback',
+                'title': 'Добавить в корзину',
+                'payload': f"{product['id']}_{product['attributes']['name']}",
+            }
+        ]
+    }
+
+
+async def fetch_node_products(node_ids):
+    try:
+        nodes_products = await asyncio.gather(
+            *(api_async.get_node_products(os.environ['HIERARCHY_ID'], node_id) for node_id in node_ids)
+        )
+    finally:
+        await api_async.close_session()
+    return {
+        node_id: {product['id'] for product in node_products['data']}
+        for node_id, node_products in zip(node_ids, nodes_products)
+    }
+
+
+def build_catalog_snapshot(products, node_ids):
+    # Каталог, состав всех категорий и ссылки на изображения загружаются один раз для всех категорий
+    nodes_product_ids = asyncio.run(fetch_node_products(list(node_ids)))
+    node_products = [
+        product for product in products
+        if any(product['id'] in product_ids for product_ids in nodes_product_ids.values())
+    ]
+    file_links = api.get_file_links(
+        [product['relationships']['main_image']['data']['id'] for product in node_products]
+    )
+    product_elements = {}
+    for product in node_products:
+        element = get_product_element(product, file_links[product['relationships']['main_image']['data']['id']])
+        product_elements[product['id']] = (get_digest(element), element)
+    nodes = {
+        node_id: [product_elements[product['id']][0] for product in node_products if product['id'] in product_ids]
+        for node_id, product_ids in nodes_product_ids.items()
+    }
+    return {
+        'products': {product['id']: get_digest(product) for product in products},
+        'product_elements': dict(product_elements.values()),
+        'nodes': {
+            node_id: (get_digest(product_digests), product_digests)
+            for node_id, product_digests in nodes.items()
+        },
+    }
+
+
+def get_missing_keys(db, keys):
+    pipe = db.pipeline(transaction=False)
+    for key in keys:
+        pipe.exists(key)
+    return {key for key, exists in zip(keys, pipe.execute()) if not exists}
+
+
+def publish_catalog_snapshot(db, snapshot):
+    # Записываются только новые товары и категории, затем указатель на версию переключается одной командой
+    previous_version = db.get(CURRENT_VERSION_KEY)
+    previous_version = previous_version.decode('utf-8') if previous_version else None
+    version = str(time.time_ns())
+    product_keys = {
+        PRODUCT_KEY.format(digest=digest): element
+        for digest, element in snapshot['product_elements'].items()
+    }
+    node_keys = {
+        NODE_KEY.format(digest=node_digest): product_digests
+        for node_digest, product_digests in snapshot['nodes'].values()
+    }
+    missing_keys = get_missing_keys(db, list(product_keys) + list(node_keys))
+
+    pipe = db.pipeline(transaction=True)
+    for key, content in {**product_keys, **node_keys}.items():
+        if key in missing_keys:
+            pipe.set(key, json.dumps(content, ensure_ascii=False), ex=CONTENT_TTL)
+        else:
+            pipe.expire(key, CONTENT_TTL)
+    manifest_key = MANIFEST_KEY.format(version=version)
+    pipe.hset(manifest_key, mapping={node_id: node_digest for node_id, (node_digest, __) in snapshot['nodes'].items()})
+    if snapshot['products']:
+        pipe.hset(PRODUCTS_KEY.format(version=version), mapping=snapshot['products'])
+    pipe.set(CURRENT_VERSION_KEY, version)
+    if previous_version:
+        pipe.expire(MANIFEST_KEY.format(version=previous_version), PREVIOUS_VERSION_TTL)
+        pipe.expire(PRODUCTS_KEY.format(version=previous_version), PREVIOUS_VERSION_TTL)
+    pipe.execute()
+    logger.info(f'Опубликована версия каталога {version}, новых записей: {len(missing_keys)}')
+    return previous_version, version
+
+
+def get_changed_products(db, previous_version, products):
+    if not previous_version:
+        return set(products)
+    previous_products = {
+        product_id.decode('utf-8'): digest.decode('utf-8')
+        for product_id, digest in db.hgetall(PRODUCTS_KEY.format(version=previous_version)).items()
+    }
+    return {
+        product_id for product_id in set(products) | set(previous_products)
+        if products.get(product_id) != previous_products.get(product_id)
+    }
+
+
+def refresh_catalog(db, node_ids):
+    # Обновления из очереди и при пустом кэше выполняются по одному на все процессы
+    with db.lock(REFRESH_LOCK_KEY, timeout=REFRESH_LOCK_TIMEOUT, blocking_timeout=REFRESH_LOCK_TIMEOUT):
+        _refresh_catalog(db, node_ids)
+
+
+def _refresh_catalog(db, node_ids):
+    db.delete(REFRESH_PENDING_KEY)
+    products = api.fetch_products()
+    snapshot = build_catalog_snapshot(products['data'], node_ids)
+    previous_version, __ = publish_catalog_snapshot(db, snapshot)
+    # Кэш каталога api_store заменяется новым значением, а не очищается: читатели не остаются без данных
+    api.catalog_cache.set('products', products)
+    for product_id in get_changed_products(db, previous_version, snapshot['products']):
+        api.catalog_cache.delete(f'product:{product_id}')
+    api.catalog_cache.publish_invalidation()
+
+
+def mark_refresh_pending(db):
+    # Повторные вебхуки, пришедшие до начала обновления, не ставят новую задачу
+    return bool(db.set(REFRESH_PENDING_KEY, 1, nx=True, ex=REFRESH_PENDING_TTL))
+
+
+def get_node_elements(db, node_id):
+    global _read_node_script
+    version = db.get(CURRENT_VERSION_KEY)
+    if version is None:
+        return None
+    if _read_node_script is None:
+        # Скрипт вызывается через EVALSHA, его текст не передается при каждом чтении меню
+        _read_node_script = db.register_script(READ_NODE_SCRIPT)
+    manifest_key = MANIFEST_KEY.format(version=version.decode('utf-8'))
+    node_elements = _read_node_script(keys=[manifest_key], args=[node_id], client=db)
+    return json.loads(node_elements) if node_elements is not None else None
+
+
+def ensure_node_elements(db, node_id, node_ids):
+    """
+    Возвращает элементы категории node_id, а если каталога еще нет - собирает его для категорий node_ids.
+    Каталог собирает только процесс, получивший блокировку, остальные дожидаются и читают готовую версию.
+    """
+    node_elements = get_node_elements(db, node_id)
+    if node_elements is not None:
+        return node_elements
+    with db.lock(REFRESH_LOCK_KEY, timeout=REFRESH_LOCK_TIMEOUT, blocking_timeout=REFRESH_LOCK_TIMEOUT):
+        node_elements = get_node_elements(db, node_id)
+        if node_elements is None:
+            _refresh_catalog(db, node_ids)
+            node_elements = get_node_elements(db, node_id)
+    return node_elements
@@ -0,0 +1,67 @@
+import json
+import os
+import zlib
+
+QUEUE_PARTITIONS = int(os.getenv('FB_QUEUE_PARTITIONS', 8))
+QUEUE_KEY = 'fb_events:{partition}'
+PROCESSING_KEY = 'fb_events:{partition}:processing'
+DEAD_LETTER_KEY = 'fb_events:dead'
+MAX_ATTEMPTS = 3
+
+
+def get_partition(sender_id):
+    # События одного отправителя всегда попадают в одну очередь - так сохраняется их порядок
+    return zlib.crc32(str(sender_id).encode()) % QUEUE_PARTITIONS
+
+
+def enqueue_event(db, event, partition_key):
+    db.lpush(QUEUE_KEY.format(partition=get_partition(partition_key)), json.dumps(event))
+
+
+def claim_event(db, partition, timeout=5):
+    # Событие атомарно переносится в список обрабатываемых и не теряется при падении обработчика
+    return db.brpoplpush(
+        QUEUE_KEY.format(partition=partition),
+        PROCESSING_KEY.format(partition=partition),
+        timeout=timeout
+    )
+
+
+def ack_event(db, partition, raw_event):
+    db.lrem(PROCESSING_KEY.format(partition=partition), 1, raw_event)
+
+
+def requeue_unfinished(db, partition):
+    # Незавершенные события возвращаются в начало очереди, чтобы обработаться первыми.
+    # Новейшие события лежат слева, поэтому самое старое оказывается у правого, читаемого конца очереди
+    while db.lmove(
+        PROCESSING_KEY.format(partition=partition),
+        QUEUE_KEY.format(partition=partition),
+        src='LEFT',
+        dest='RIGHT'
+    ):
+        pass
+
+
+def retry_event(db, partition, raw_event, max_attempts=MAX_ATTEMPTS):
+    """
+    Возвращает событие, обработка которого завершилась ошибкой, в начало очереди, а после max_attempts попыток
+    переносит его в список DEAD_LETTER_KEY. Возвращает True, если событие будет обработано повторно.
+    """
+    try:
+        event = json.loads(raw_event)
+        event['attempts'] = event.get('attempts', 0) + 1
+        retry = event['attempts'] < max_attempts
+        raw_event_to_save = json.dumps(event)
+    except (ValueError, AttributeError):
+        # Поврежденное событие повторять бесполезно
+        retry = False
+        raw_event_to_save = raw_event
+    pipe = db.pipeline(transaction=True)
+    pipe.lrem(PROCESSING_KEY.format(partition=partition), 1, raw_event)
+    if retry:
+        pipe.rpush(QUEUE_KEY.format(partition=partition), raw_event_to_save)
+    else:
+        pipe.lpush(DEAD_LETTER_KEY, raw_event_to_save)
+    pipe.execute()
+    return retry
@@ -0,0 +1,66 @@
+import os
+
+SESSION_KEY = 'fb_session:{user_id}'
+SESSION_TTL = int(os.getenv('FB_SESSION_TTL', 30 * 24 * 3600))
+# Ключи, в которых состояние пользователя хранилось до появления общей сессии
+LEGACY_KEYS = {
+    'state': 'facebookid_{user_id}',
+    'email': '{user_id}_mail',
+    'phone': '{user_id}_phone',
+    'customer_id': '{user_id}_customer_id',
+}
+
+
+class UserSession:
+    """
+    Состояние пользователя Facebook: загружается одним запросом к Redis на событие,
+    изменения записываются обратно одним конвейером в save_session.
+    """
+
+    def __init__(self, user_id, data=None):
+        self.user_id = user_id
+        self.data = data or {}
+        self.changes = {}
+        self.legacy = False
+
+    def get(self, field, default=None):
+        return self.data.get(field, default)
+
+    def set(self, field, value):
+        self.data[field] = value
+        self.changes[field] = value
+
+
+def load_legacy_session(db, user_id):
+    fields = list(LEGACY_KEYS)
+    values = db.mget([LEGACY_KEYS[field].format(user_id=user_id) for field in fields])
+    session = UserSession(user_id)
+    session.legacy = True
+    for field, value in zip(fields, values):
+        if value is not None:
+            session.set(field, value.decode('utf-8'))
+    return session
+
+
+def load_session(db, user_id):
+    data = db.hgetall(SESSION_KEY.format(user_id=user_id))
+    if not data:
+        # Старые ключи переносятся в сессию при первом обращении и удаляются при сохранении
+        return load_legacy_session(db, user_id)
+    return UserSession(
+        user_id,
+        {field.decode('utf-8'): value.decode('utf-8') for field, value in data.items()}
+    )
+
+
+def save_session(db, session):
+    session_key = SESSION_KEY.format(user_id=session.user_id)
+    pipe = db.pipeline(transaction=True)
+    if session.changes:
+        pipe.hset(session_key, mapping=session.changes)
+    if session.legacy:
+        pipe.delete(*(key.format(user_id=session.user_id) for key in LEGACY_KEYS.values()))
+    pipe.expire(session_key, SESSION_TTL)
+    pipe.execute()
+    session.changes = {}
+    session.legacy = False
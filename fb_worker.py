@@ -0,0 +1,76 @@
+import argparse
+import json
+import logging
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+import fb_queue
+from fb_bot import db, handle_users_reply, CATALOG_NODE_IDS
+from fb_catalog import refresh_catalog
+
+logger = logging.getLogger('fb_worker')
+
+QUEUE_RETRY_DELAY = 5
+
+
+def handle_event(partition, raw_event):
+    try:
+        event = json.loads(raw_event)
+        if event.get('type') == 'catalog_refresh':
+            refresh_catalog(db, CATALOG_NODE_IDS)
+        else:
+            handle_users_reply(event)
+    except RedisError:
+        # Событие остается в списке обрабатываемых и вернется в очередь после восстановления соединения
+        raise
+    except Exception:
+        logger.exception(f'Ошибка обработки события из очереди {partition}')
+        if fb_queue.retry_event(db, partition, raw_event):
+            time.sleep(QUEUE_RETRY_DELAY)
+        else:
+            logger.error(f'Событие перенесено в {fb_queue.DEAD_LETTER_KEY} после {fb_queue.MAX_ATTEMPTS} попыток')
+    else:
+        fb_queue.ack_event(db, partition, raw_event)
+
+
+def process_partition(partition):
+    while True:
+        try:
+            fb_queue.requeue_unfinished(db, partition)
+            while True:
+                raw_event = fb_queue.claim_event(db, partition)
+                if raw_event is not None:
+                    handle_event(partition, raw_event)
+        except RedisError:
+            # Очередь не должна остаться без обработчика: после паузы незавершенные события возвращаются в очередь
+            logger.exception(f'Потеряно соединение с Redis в очереди {partition}')
+            time.sleep(QUEUE_RETRY_DELAY)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Обработчик событий Facebook из очереди Redis')
+    parser.add_argument(
+        '--partitions',
+        type=int,
+        nargs='*',
+        default=list(range(fb_queue.QUEUE_PARTITIONS)),
+        help='Номера очередей, которые обрабатывает процесс. Каждую очередь должен читать только один процесс'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    workers = [
+        threading.Thread(target=process_partition, args=(partition,), name=f'fb-queue-{partition}')
+        for partition in args.partitions
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f'Обработчик событий Facebook запущен, очереди: {args.partitions}')
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    main()
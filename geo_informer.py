@@ -1,9 +1,65 @@
+import logging
+import re
+import threading
+import time
+
+import numpy as np
 import requests
-from geopy import distance
-from api_store import get_all_entries
+from scipy.spatial import cKDTree
+import api_store as api
+from api_store import get_redis
+from cache import LayeredCache, MISSING
+
+EARTH_RADIUS_KM = 6371.0088
+BRANCH_INDEX_TTL = 3600
+BRANCH_INDEX_RETRY_DELAY = 60
+GEOCODE_CACHE_SIZE = 4096
+GEOCODE_LOCAL_TTL = 3600
+GEOCODE_REDIS_TTL = 30 * 24 * 3600
+GEOCODE_NEGATIVE_TTL = 600
+
+geocode_cache = LayeredCache(
+    'geocode',
+    get_redis,
+    maxsize=GEOCODE_CACHE_SIZE,
+    local_ttl=GEOCODE_LOCAL_TTL,
+    redis_ttl=GEOCODE_REDIS_TTL
+)
+
+logger = logging.getLogger(__name__)
+
+_branch_index = None
+_branch_index_lock = threading.Lock()
+_branch_index_hooks = []
+_rebuild_lock = threading.Lock()
+_rebuild_requested = False
+_rebuild_thread = None
+
+
+def normalize_address(address):
+    address = address.lower().replace('ё', 'е')
+    address = re.sub(r'\s*([,.;])\s*', r'\1 ', address)
+    return ' '.join(address.split()).strip(' ,.;')
 
 
 def fetch_coordinates(apikey, address):
+    cache_key = normalize_address(address)
+    coordinates = geocode_cache.get(cache_key)
+    if coordinates is not MISSING:
+        return tuple(coordinates) if coordinates else None
+    coordinates = request_coordinates(apikey, address)
+    if coordinates:
+        geocode_cache.set(cache_key, coordinates)
+    else:
+        geocode_cache.set(cache_key, None, local_ttl=GEOCODE_NEGATIVE_TTL, redis_ttl=GEOCODE_NEGATIVE_TTL)
+    return coordinates
+
+
+def get_geocode_stats():
+    return geocode_cache.get_stats()
+
+
+def request_coordinates(apikey, address):
     base_url = 'https://geocode-maps.yandex.ru/1.x'
     response = requests.get(base_url, params={
         'geocode': address,
@@ -22,16 +78,133 @@ def fetch_coordinates(apikey, address):
     return float(lat), float(lng)
 
 
-def get_min_distance_branch(client_pos):
-    branches = get_all_entries()
-    branch_distances = []
-    for branch in branches['data']:
-        branch_pos = (branch['latitude'], branch['longitude'])
-        dist = distance.distance(client_pos, branch_pos).km
-        branch_distances.append(
-            {'address': branch['address'], 'dist': dist, 'telegram_id': branch['telegram_id']}
+def to_unit_vectors(radian_coords):
+    lat, lng = radian_coords[..., 0], radian_coords[..., 1]
+    return np.stack((np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)), axis=-1)
+
+
+def haversine_km(radian_coords_1, radian_coords_2):
+    lat_1, lng_1 = radian_coords_1[..., 0], radian_coords_1[..., 1]
+    lat_2, lng_2 = radian_coords_2[..., 0], radian_coords_2[..., 1]
+    a = (
+        np.sin((lat_2 - lat_1) / 2) ** 2
+        + np.cos(lat_1) * np.cos(lat_2) * np.sin((lng_2 - lng_1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class BranchIndex:
+    """
+    KD-дерево по координатам филиалов на единичной сфере.
+    Порядок по длине хорды совпадает с порядком по расстоянию на сфере,
+    поэтому дерево находит ближайшие филиалы, а расстояние в км уточняется по гаверсинусу.
+    """
+
+    def __init__(self, branches):
+        self.branches = branches
+        self.coords = np.radians(
+            np.array([(branch['latitude'], branch['longitude']) for branch in branches], dtype=float)
         )
-    branch_distances.sort(key=lambda x: x['dist'])
-    selected_branch = branch_distances[0]
+        self.tree = cKDTree(to_unit_vectors(self.coords))
+        self.created_at = time.monotonic()
+
+    def query(self, positions, k=1):
+        positions = np.radians(np.atleast_2d(np.asarray(positions, dtype=float)))
+        k = min(k, len(self.branches))
+        __, indexes = self.tree.query(to_unit_vectors(positions), k=k)
+        indexes = np.asarray(indexes).reshape(len(positions), k)
+        distances = haversine_km(positions[:, np.newaxis, :], self.coords[indexes])
+        return indexes, distances
+
+
+def add_branch_index_hook(hook):
+    # hook(branch_index) строит производные данные для нового индекса до того, как он станет текущим
+    _branch_index_hooks.append(hook)
+
+
+def build_branch_index():
+    branch_index = BranchIndex(api.get_branches())
+    for hook in _branch_index_hooks:
+        hook(branch_index)
+    return branch_index
+
+
+def get_branch_index():
+    global _branch_index
+    branch_index = _branch_index
+    if branch_index is None:
+        # Индекса еще нет только сразу после запуска процесса - его приходится построить здесь
+        with _branch_index_lock:
+            if _branch_index is None:
+                _branch_index = build_branch_index()
+            return _branch_index
+    if time.monotonic() - branch_index.created_at > BRANCH_INDEX_TTL:
+        schedule_branch_index_rebuild()
+    return branch_index
+
+
+def _rebuild_branch_index():
+    global _branch_index, _rebuild_requested, _rebuild_thread
+    while True:
+        with _rebuild_lock:
+            if not _rebuild_requested:
+                _rebuild_thread = None
+                return
+            _rebuild_requested = False
+        try:
+            branch_index = build_branch_index()
+        except Exception:
+            logger.exception('Не удалось перестроить индекс филиалов')
+            if _branch_index is not None:
+                _branch_index.created_at = time.monotonic() - BRANCH_INDEX_TTL + BRANCH_INDEX_RETRY_DELAY
+            continue
+        with _branch_index_lock:
+            _branch_index = branch_index
+
+
+def schedule_branch_index_rebuild():
+    """
+    Перестраивает индекс филиалов в фоновом потоке, запросы пользователей до замены работают со старым индексом.
+    Повторные вызовы во время перестроения объединяются в одно следующее перестроение.
+    """
+    global _rebuild_requested, _rebuild_thread
+    with _rebuild_lock:
+        _rebuild_requested = True
+        if _rebuild_thread is None:
+            _rebuild_thread = threading.Thread(target=_rebuild_branch_index, name='branch-index', daemon=True)
+            _rebuild_thread.start()
+
+
+def invalidate_branch_index():
+    schedule_branch_index_rebuild()
+
+
+def get_nearest_branches_batch(positions, k=1):
+    branch_index = get_branch_index()
+    indexes, distances = branch_index.query(positions, k)
+    return [
+        [
+            {
+                'address': branch_index.branches[index]['address'],
+                'dist': float(dist),
+                'telegram_id': branch_index.branches[index]['telegram_id'],
+                'latitude': branch_index.branches[index]['latitude'],
+                'longitude': branch_index.branches[index]['longitude'],
+            }
+            for index, dist in zip(position_indexes, position_distances)
+        ]
+        for position_indexes, position_distances in zip(indexes, distances)
+    ]
+
+
+def get_nearest_branches(client_pos, k=1):
+    return get_nearest_branches_batch([client_pos], k)[0]
+
+
+def get_min_distance_branch(client_pos):
+    selected_branch = get_nearest_branches(client_pos)[0]
 
     return selected_branch['address'], selected_branch['dist'], selected_branch['telegram_id']
+
+
+api.branches_cache.add_invalidation_hook(schedule_branch_index_rebuild)
@@ -0,0 +1,160 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+from redis.exceptions import LockError, LockNotOwnedError
+
+import api_store as api
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = 'local_cart:{reference}'
+LOCK_KEY = 'local_cart:{reference}:lock'
+REJECTED_KEY = 'local_cart:{reference}:rejected'
+DIRTY_KEY = 'local_cart:dirty'
+FLUSH_DELAY = 2
+FLUSH_INTERVAL = 1
+FLUSH_BATCH = 100
+LOCK_TIMEOUT = 30
+REJECTED_TTL = 24 * 3600
+
+_cart_flusher = None
+
+
+def add_item(db, reference, product_id, quantity=1):
+    # Нажатия записываются в Redis и сразу подтверждаются пользователю, в Moltin они уходят одним запросом позже
+    pipe = db.pipeline(transaction=True)
+    pipe.hincrby(PENDING_KEY.format(reference=reference), product_id, quantity)
+    pipe.zadd(DIRTY_KEY, {reference: time.time()}, nx=True)
+    pipe.execute()
+    api.forget_cart_reads()
+
+
+def take_pending(db, reference):
+    pipe = db.pipeline(transaction=True)
+    pipe.hgetall(PENDING_KEY.format(reference=reference))
+    pipe.delete(PENDING_KEY.format(reference=reference))
+    pipe.zrem(DIRTY_KEY, reference)
+    pending, __, __ = pipe.execute()
+    return {product_id.decode('utf-8'): int(quantity) for product_id, quantity in pending.items()}
+
+
+def restore_pending(db, reference, pending):
+    pipe = db.pipeline(transaction=True)
+    for product_id, quantity in pending.items():
+        pipe.hincrby(PENDING_KEY.format(reference=reference), product_id, quantity)
+    pipe.zadd(DIRTY_KEY, {reference: time.time()}, nx=True)
+    pipe.execute()
+
+
+def has_pending(db, reference):
+    # Корзину может отправлять в Moltin другой процесс - тогда нужно дождаться снятия его блокировки
+    pipe = db.pipeline(transaction=False)
+    pipe.zscore(DIRTY_KEY, reference)
+    pipe.exists(LOCK_KEY.format(reference=reference))
+    dirty, locked = pipe.execute()
+    return dirty is not None or bool(locked)
+
+
+def record_rejected(db, reference, rejected):
+    pipe = db.pipeline(transaction=True)
+    for product_id, quantity in rejected.items():
+        pipe.hincrby(REJECTED_KEY.format(reference=reference), product_id, quantity)
+    pipe.expire(REJECTED_KEY.format(reference=reference), REJECTED_TTL)
+    pipe.execute()
+
+
+def take_rejected(db, reference):
+    """
+    Возвращает и забывает добавления, которые Moltin отклонил при отправке корзины reference.
+    """
+    pipe = db.pipeline(transaction=True)
+    pipe.hgetall(REJECTED_KEY.format(reference=reference))
+    pipe.delete(REJECTED_KEY.format(reference=reference))
+    rejected, __ = pipe.execute()
+    return {product_id.decode('utf-8'): int(quantity) for product_id, quantity in rejected.items()}
+
+
+def push_pending(reference, pending, rejected, lock):
+    remaining = dict(pending)
+    try:
+        for product_id, quantity in pending.items():
+            if quantity > 0:
+                # Срок блокировки продлевается перед каждым запросом: корзина из нескольких товаров
+                # при медленном Moltin отправляется дольше LOCK_TIMEOUT
+                lock.extend(LOCK_TIMEOUT, replace_ttl=True)
+                try:
+                    api.add_product_to_cart(product_id=product_id, quantity=quantity, reference=reference)
+                except requests.exceptions.HTTPError as error:
+                    if error.response is None or error.response.status_code >= 500:
+                        raise
+                    logger.exception(f'Moltin отклонил добавление {product_id} в корзину {reference}')
+                    rejected[product_id] = quantity
+            del remaining[product_id]
+    finally:
+        pending.clear()
+        pending.update(remaining)
+
+
+def flush_cart(db, reference):
+    """
+    Отправляет в Moltin накопленные добавления товаров в корзину reference.
+    Вызывается перед чтением корзины и оформлением заказа, а также фоновым потоком.
+    """
+    if not has_pending(db, reference):
+        return
+    lock = db.lock(LOCK_KEY.format(reference=reference), timeout=LOCK_TIMEOUT)
+    if not lock.acquire(blocking_timeout=LOCK_TIMEOUT):
+        # Без накопленных добавлений корзину нельзя ни показывать, ни оформлять
+        raise LockError(f'Корзина {reference} заблокирована другим процессом дольше {LOCK_TIMEOUT} с')
+    try:
+        pending = take_pending(db, reference)
+        rejected = {}
+        try:
+            push_pending(reference, pending, rejected, lock)
+        finally:
+            # Неотправленные из-за ошибки соединения добавления возвращаются и будут отправлены повторно
+            if pending:
+                restore_pending(db, reference, pending)
+            # Отклоненные Moltin добавления показываются покупателю при следующем чтении корзины
+            if rejected:
+                record_rejected(db, reference, rejected)
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            logger.warning(f'Блокировка корзины {reference} истекла до окончания отправки')
+
+
+def flush_due_carts(db, flush_delay=FLUSH_DELAY):
+    due_references = db.zrangebyscore(DIRTY_KEY, '-inf', time.time() - flush_delay, start=0, num=FLUSH_BATCH)
+    for reference in due_references:
+        reference = reference.decode('utf-8')
+        try:
+            flush_cart(db, reference)
+        except (requests.exceptions.RequestException, LockError):
+            logger.exception(f'Не удалось отправить корзину {reference} в Moltin')
+
+
+def _flush_carts_forever(db, flush_delay):
+    while True:
+        try:
+            flush_due_carts(db, flush_delay)
+        except Exception:
+            logger.exception('Ошибка фоновой отправки корзин в Moltin')
+        time.sleep(FLUSH_INTERVAL)
+
+
+def start_cart_flusher(db):
+    global _cart_flusher
+    if _cart_flusher is None:
+        api.add_cart_flush_hook(lambda reference: flush_cart(db, reference))
+        api.add_cart_rejected_hook(lambda reference: take_rejected(db, reference))
+        # .env читается при запуске бота, уже после импорта модуля
+        flush_delay = float(os.getenv('LOCAL_CART_FLUSH_DELAY', FLUSH_DELAY))
+        _cart_flusher = threading.Thread(
+            target=_flush_carts_forever, args=(db, flush_delay), name='local-cart', daemon=True
+        )
+        _cart_flusher.start()
@@ -0,0 +1,77 @@
+import contextvars
+import functools
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_current_scope = contextvars.ContextVar('request_scope', default=None)
+_saved_calls = Counter()
+_saved_calls_lock = threading.Lock()
+
+
+class RequestScope:
+    """
+    Результаты чтений, сделанных во время обработки одного обновления от пользователя.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.results = {}
+        self.saved_calls = Counter()
+
+    def forget(self, func_name):
+        for key in [key for key in self.results if key[0] == func_name]:
+            del self.results[key]
+
+
+@contextmanager
+def request_scope(name):
+    scope = RequestScope(name)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+        if scope.saved_calls:
+            logger.debug(f'{name}: повторные запросы взяты из памяти {dict(scope.saved_calls)}')
+            with _saved_calls_lock:
+                for func_name, count in scope.saved_calls.items():
+                    _saved_calls[(name, func_name)] += count
+
+
+def memoize(func):
+    # Вне request_scope функция вызывается как обычно, внутри - один раз для одинаковых аргументов
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        scope = _current_scope.get()
+        if scope is None:
+            return func(*args, **kwargs)
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            if key in scope.results:
+                scope.saved_calls[func.__name__] += 1
+                return scope.results[key]
+        except TypeError:
+            return func(*args, **kwargs)
+        result = func(*args, **kwargs)
+        scope.results[key] = result
+        return result
+    return wrapper
+
+
+def forget(*funcs):
+    scope = _current_scope.get()
+    if scope is not None:
+        for func in funcs:
+            scope.forget(func.__name__)
+
+
+def get_saved_calls():
+    """
+    Число повторных запросов, сэкономленных с запуска процесса, по парам (обработчик, функция).
+    """
+    with _saved_calls_lock:
+        return dict(_saved_calls)
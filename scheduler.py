@@ -0,0 +1,93 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+SCHEDULED_KEY = 'scheduled_jobs'
+PROCESSING_KEY = 'scheduled_jobs:processing'
+CLAIM_LIMIT = 100
+VISIBILITY_TIMEOUT = 60
+POLL_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+_scheduler = None
+
+# Наступившие задачи переносятся в список обрабатываемых одним скриптом: каждую задачу получает только один процесс
+CLAIM_SCRIPT = '''
+local jobs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for i, job in ipairs(jobs) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('ZADD', KEYS[2], ARGV[3], job)
+end
+return jobs
+'''
+
+# Задачи, которые не были подтверждены до истечения срока, возвращаются в расписание
+REQUEUE_SCRIPT = '''
+local jobs = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for i, job in ipairs(jobs) do
+    redis.call('ZREM', KEYS[2], job)
+    redis.call('ZADD', KEYS[1], ARGV[1], job)
+end
+return #jobs
+'''
+
+
+def schedule_job(db, name, delay, payload=None):
+    job = json.dumps({'id': uuid.uuid4().hex, 'name': name, 'payload': payload})
+    db.zadd(SCHEDULED_KEY, {job: time.time() + delay})
+
+
+def claim_due_jobs(db, limit=CLAIM_LIMIT, visibility_timeout=VISIBILITY_TIMEOUT):
+    now = time.time()
+    return db.eval(CLAIM_SCRIPT, 2, SCHEDULED_KEY, PROCESSING_KEY, now, limit, now + visibility_timeout)
+
+
+def ack_job(db, raw_job):
+    db.zrem(PROCESSING_KEY, raw_job)
+
+
+def requeue_stale_jobs(db):
+    return db.eval(REQUEUE_SCRIPT, 2, SCHEDULED_KEY, PROCESSING_KEY, time.time())
+
+
+def run_due_jobs(db, callbacks, limit=CLAIM_LIMIT):
+    """
+    Выполняет наступившие задачи пакетами не больше limit, callbacks - словарь имя задачи -> функция(payload).
+    Задачи процесса, упавшего во время выполнения, повторяются после VISIBILITY_TIMEOUT.
+    """
+    requeue_stale_jobs(db)
+    while raw_jobs := claim_due_jobs(db, limit):
+        for raw_job in raw_jobs:
+            try:
+                job = json.loads(raw_job)
+                callbacks[job['name']](job['payload'])
+            except Exception:
+                logger.exception(f'Ошибка выполнения отложенной задачи {raw_job}')
+            finally:
+                ack_job(db, raw_job)
+        if len(raw_jobs) < limit:
+            break
+
+
+def _run_jobs_forever(db, callbacks, interval):
+    while True:
+        try:
+            run_due_jobs(db, callbacks)
+        except Exception:
+            logger.exception('Ошибка опроса отложенных задач')
+        time.sleep(interval)
+
+
+def start_scheduler(db, callbacks, interval=POLL_INTERVAL):
+    """
+    Запускает фоновый поток, который раз в interval секунд выполняет наступившие задачи.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = threading.Thread(
+            target=_run_jobs_forever, args=(db, callbacks, interval), name='scheduler', daemon=True
+        )
+        _scheduler.start()
@@ -0,0 +1,73 @@
+import json
+import os
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+USER_DATA_KEY = 'tg_user_data:{user_id}'
+USER_DATA_TTL = 30 * 24 * 3600
+
+
+class RedisPersistence(BasePersistence):
+    """
+    Хранение user_data бота Telegram в Redis рядом с состоянием диалога.
+    Данные пользователя загружаются перед обработкой каждого его обновления,
+    а записываются обратно только если изменились, поэтому бот можно запускать в нескольких процессах.
+    После записи данные пользователя удаляются из памяти процесса.
+    """
+
+    def __init__(self, db, ttl=None):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.db = db
+        # .env читается при запуске бота, уже после импорта модуля
+        self.ttl = ttl or int(os.getenv('TG_USER_DATA_TTL', USER_DATA_TTL))
+        self._saved = {}
+        self._user_data = None
+
+    @staticmethod
+    def _dump(data):
+        return json.dumps(data, sort_keys=True, ensure_ascii=False)
+
+    def get_user_data(self):
+        # Данные не загружаются заранее: каждый пользователь читается в refresh_user_data
+        return defaultdict(dict)
+
+    def track_user_data(self, user_data):
+        # BasePersistence отдает диспетчеру копию get_user_data, поэтому его user_data передается явно
+        self._user_data = user_data
+
+    def refresh_user_data(self, user_id, user_data):
+        raw_data = self.db.get(USER_DATA_KEY.format(user_id=user_id))
+        data = json.loads(raw_data) if raw_data else {}
+        user_data.clear()
+        user_data.update(data)
+        self._saved[user_id] = self._dump(data)
+
+    def update_user_data(self, user_id, data):
+        dumped_data = self._dump(data)
+        if self._saved.pop(user_id, self._dump({})) != dumped_data:
+            if data:
+                self.db.set(USER_DATA_KEY.format(user_id=user_id), dumped_data, ex=self.ttl)
+            else:
+                self.db.delete(USER_DATA_KEY.format(user_id=user_id))
+        # Перед следующим обновлением данные все равно загружаются из Redis заново
+        if self._user_data is not None:
+            self._user_data.pop(user_id, None)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return {}
+
+    def update_conversation(self, name, key, new_state):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
@@ -0,0 +1,98 @@
+import logging
+import time
+
+from telegram import InputMediaPhoto, Message
+from telegram.error import BadRequest, RetryAfter
+
+import api_store as api
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_FILE_IDS_KEY = 'tg_file_ids'
+
+
+def get_image_id(product):
+    return product['relationships']['main_image']['data']['id']
+
+
+def get_photo_link(image_id, link=None):
+    return link or api.get_file_link(image_id)
+
+
+def get_photo(db, image_id, link=None):
+    # Фото, которое уже загружалось в Telegram, отправляется по file_id без повторного скачивания по ссылке
+    file_id = db.hget(TELEGRAM_FILE_IDS_KEY, image_id)
+    if file_id is not None:
+        return file_id.decode('utf-8'), True
+    return get_photo_link(image_id, link), False
+
+
+def remember_photo(db, image_id, message):
+    # Для inline-сообщений редактирование возвращает True вместо сообщения
+    if isinstance(message, Message) and message.photo:
+        db.hset(TELEGRAM_FILE_IDS_KEY, image_id, message.photo[-1].file_id)
+
+
+def forget_photo(db, image_id):
+    db.hdel(TELEGRAM_FILE_IDS_KEY, image_id)
+
+
+def send_cached_photo(bot, db, chat_id, image_id, link=None, **kwargs):
+    """
+    Отправляет фото по file_id, а если его еще нет - по ссылке link или ссылке на файл Moltin image_id.
+    """
+    photo, is_file_id = get_photo(db, image_id, link)
+    try:
+        message = bot.send_photo(chat_id, photo=photo, **kwargs)
+    except BadRequest:
+        if not is_file_id:
+            raise
+        # file_id мог стать недействительным, например после смены токена бота
+        forget_photo(db, image_id)
+        is_file_id = False
+        message = bot.send_photo(chat_id, photo=get_photo_link(image_id, link), **kwargs)
+    if not is_file_id:
+        remember_photo(db, image_id, message)
+    return message
+
+
+def edit_cached_photo(bot, db, chat_id, message_id, image_id, link=None, caption=None, parse_mode=None,
+                      reply_markup=None):
+    # Фото, подпись и клавиатура сообщения заменяются одним запросом
+    photo, is_file_id = get_photo(db, image_id, link)
+    message = bot.edit_message_media(
+        chat_id,
+        message_id,
+        media=InputMediaPhoto(photo, caption=caption, parse_mode=parse_mode),
+        reply_markup=reply_markup
+    )
+    if not is_file_id:
+        remember_photo(db, image_id, message)
+    return message
+
+
+def warm_up_photos(bot, db, chat_id):
+    """
+    Загружает в служебный чат фото всех товаров, для которых еще нет file_id.
+    Возвращает число загруженных фото.
+    """
+    image_ids = list(dict.fromkeys(get_image_id(product) for product in api.get_products()['data']))
+    known_ids = db.hmget(TELEGRAM_FILE_IDS_KEY, image_ids) if image_ids else []
+    missing_ids = [image_id for image_id, file_id in zip(image_ids, known_ids) if file_id is None]
+    file_links = api.get_file_links(missing_ids)
+    uploaded = 0
+    for image_id in missing_ids:
+        while True:
+            try:
+                message = bot.send_photo(chat_id, photo=file_links[image_id], disable_notification=True)
+                break
+            except RetryAfter as error:
+                time.sleep(error.retry_after)
+            except BadRequest:
+                logger.exception(f'Не удалось загрузить фото {image_id}')
+                message = None
+                break
+        if message:
+            remember_photo(db, image_id, message)
+            uploaded += 1
+    return uploaded
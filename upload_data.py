@@ -1,6 +1,7 @@
 import json
 import os
 import api_store as api
+import redis
 import requests
 
 from environs import Env
@@ -57,6 +58,13 @@ def upload_addresses(file='addresses.json', flow_slug='branch-addresses'):
 if __name__ == '__main__':
     env = Env()
     env.read_env()
+    if env('DATABASE_HOST', None):
+        # Через Redis запущенные боты узнают о новых филиалах и перестраивают индекс
+        api.init_redis(redis.Redis(
+            host=env('DATABASE_HOST'),
+            port=env.int('DATABASE_PORT'),
+            password=env('DATABASE_PASSWORD')
+        ))
     api.check_token()
 
     # Создание модели для адреса филиала